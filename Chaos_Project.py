@@ -1,8 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
+import json
 import math
+import multiprocessing
+import os
 import random
+import tempfile
 import time
+from multiprocessing import shared_memory
 from mpl_toolkits.mplot3d import Axes3D
 
 '''
@@ -28,24 +33,57 @@ evenly-distributing-n-points-on-a-sphere
 def fibonacci_sphere(samples, randomize):
     '''
     Generate a ~almost~ even distribution of points across a sphere.
+    Returns a (samples, 3) array, all the points made at once.
     '''
     #randomize is True or a seed val
     rnd = 1.
-    if randomize:
+    if randomize is True:
         rnd = random.random() * samples
     else:
-        random.seed(randomize)
-        rnd = random.random() * samples
-    points = []
+        #Own generator, so the same seed always gives the same points.
+        rnd = random.Random(randomize).random() * samples
     offset = 2./samples
     increment = math.pi * (3. - math.sqrt(5.));
-    for i in range(samples):
-        y = ((i * offset) - 1) + (offset / 2);
-        r = math.sqrt(1 - pow(y,2))
-        phi = ((i + rnd) % samples) * increment
-        x = math.cos(phi) * r
-        z = math.sin(phi) * r
-        points.append([x,y,z])
+    i = np.arange(samples)
+    y = ((i * offset) - 1) + (offset / 2);
+    r = np.sqrt(1 - y**2)
+    phi = ((i + rnd) % samples) * increment
+    points = np.empty((samples, 3))
+    points[:, 0] = np.cos(phi) * r
+    points[:, 1] = y
+    points[:, 2] = np.sin(phi) * r
+    return points
+
+def window_sphere(n, seed, theta_mi, theta_ma, phi_mi, phi_ma):
+    '''
+    n points spread ~almost~ evenly over the part of the sphere with
+    theta_mi < theta < theta_ma and phi_mi < phi < phi_ma (to_spherical2's
+    angles) and x > 0, the same region as patch2 - but made right there,
+    rather than cut out of a whole sphere of points.
+
+    Uses the fibonacci lattice again, on the (theta, z) rectangle: even
+    steps in z and theta are even areas on the sphere, so the points stay
+    evenly spread. Returns an (n, 3) array, (0, 3) if the region is empty.
+    '''
+    #x > 0 is the same as -pi/2 < theta < pi/2, and phi is a latitude.
+    theta_mi = max(theta_mi, -np.pi/2)
+    theta_ma = min(theta_ma, np.pi/2)
+    phi_mi = max(phi_mi, -np.pi/2)
+    phi_ma = min(phi_ma, np.pi/2)
+    if theta_mi >= theta_ma or phi_mi >= phi_ma:
+        return np.empty((0, 3))
+    z_mi = math.sin(phi_mi)
+    z_ma = math.sin(phi_ma)
+    rnd = random.Random(seed).random()
+    golden = (math.sqrt(5.) - 1) / 2
+    i = np.arange(n)
+    z = z_mi + (i + 0.5) / n * (z_ma - z_mi)
+    theta = theta_mi + ((i * golden + rnd) % 1) * (theta_ma - theta_mi)
+    r = np.sqrt(1 - z**2)
+    points = np.empty((n, 3))
+    points[:, 0] = np.cos(theta) * r
+    points[:, 1] = np.sin(theta) * r
+    points[:, 2] = z
     return points
 
 def into_3(original_list):
@@ -106,6 +144,22 @@ def u_val(pt, vort_vec, direct):
         vec = -vec
     return vec
 
+def u_vals(pts, vort_vec, direct, cross = None):
+    '''
+    u_val for an (N, 3) array of unit points at once. The arc length is
+    atan2(|pt x vort|, pt . vort) - arccos of the dot loses most of its
+    digits near the vortex, just where u blows up. cross can be the
+    points' cross products with the vortex if they're already worked out.
+    '''
+    vort_vec = unit_vector(vort_vec)
+    if cross is None:
+        cross = np.cross(pts, vort_vec)
+    arc_len = np.arctan2(np.linalg.norm(cross, axis = 1), np.dot(pts, vort_vec))
+    vec = 1.0 / arc_len
+    if direct < 0:
+        vec = -vec
+    return vec
+
 def mag(vect):
     #Get the mag of a vector.
     tot = 0
@@ -128,30 +182,84 @@ def angle_between(v1, v2, acute):
     else:
         return 2 * np.pi - angle
 
-def map_pt(pt_loc, vort_loc, dt, direct):
+def vort_frame(vort_loc):
     '''
-    Takes a pt, rotates it around the vortex (of the given sign in direct)
-    by u*dt in the local angle coordinate system.
+    The rotations that take a (unit) vortex onto the z axis - Ea turns it
+    into the x,z plane, then Eb down onto z - and their inverses. Only
+    map_pt_euler uses these now.
     '''
-    pt_loc = unit_vector(pt_loc)
-    vort_loc = unit_vector(vort_loc)
     #first project onto x,y plane
     x_axis = np.array([1, 0, 0])
-    y_axis = np.array([0, 1, 0])
     z_axis = np.array([0, 0, 1])
     vort_xy = [vort_loc[0], vort_loc[1], 0]
     acu = True
     if vort_loc[1] < 0:
         acu = False
-    #Find all my rotation matrices then rotate my system.
     phi = angle_between(vort_xy, x_axis, acu)
     Ea = Ez(phi)
     EaI = Ez(-phi)
     vort1 = np.matmul(Ea, vort_loc)
-    pt1 = np.matmul(Ea, pt_loc)
     theta = angle_between(vort1, z_axis, True)
     Eb = Ey(theta)
     EbI = Ey(-theta)
+    return Ea, EaI, Eb, EbI
+
+#Each vortex's axis & rotation matrices, see vort_axis.
+vort_frames = {}
+
+def vort_axis(vort_loc):
+    '''
+    Returns the vortex's unit axis k, the cross product matrix K (K x = k x x)
+    and K^2, for Rodrigues' formula for a rotation by a about k:
+        R = I + sin(a) K + (1 - cos(a)) K^2
+    They only depend on the vortex, so they're worked out once per vortex
+    and cached.
+    '''
+    key = tuple(float(c) for c in vort_loc)
+    frame = vort_frames.get(key)
+    if frame is None:
+        k = unit_vector(np.array(key))
+        K = np.array([[0, -k[2], k[1]],
+                      [k[2], 0, -k[0]],
+                      [-k[1], k[0], 0]])
+        frame = (k, K, np.matmul(K, K))
+        if len(vort_frames) < 1000: #Sweeps make lots, keep it bounded.
+            vort_frames[key] = frame
+    return frame
+
+def map_pt(pt_loc, vort_loc, dt, direct):
+    '''
+    Takes a pt, rotates it around the vortex (of the given sign in direct)
+    by u*dt in the local angle coordinate system.
+
+    Going into the vortex's frame, turning by u*dt about its z, and coming
+    back out is one rotation by -u*dt about the vortex axis, so it's done
+    in one go with Rodrigues' formula. (map_pt_euler is the frame version.)
+    '''
+    pt_loc = unit_vector(pt_loc)
+    k, K, K2 = vort_axis(vort_loc)
+    cross = np.dot(pt_loc, K) #-(k x pt), see u_vals for why atan2.
+    arc_len = math.atan2(mag(cross), np.dot(pt_loc, k))
+    delta_angle = dt/arc_len
+    if direct < 0:
+        delta_angle = -delta_angle
+    #Rows times K, so the sign of sin flips with the transpose: -sin(-d) = sin(d)
+    #1 - cos(d) = 2 sin(d/2)^2, without losing digits for small d.
+    sin = math.sin(delta_angle)
+    vers = 2*math.sin(delta_angle/2)**2
+    return pt_loc + sin*cross + vers*np.dot(pt_loc, K2)
+
+def map_pt_euler(pt_loc, vort_loc, dt, direct):
+    '''
+    The original map_pt, rotating into the vortex's frame with Euler angle
+    matrices. Kept to check map_pt against (see test_rodrigues). Doesn't
+    work for a vortex on the z axis.
+    '''
+    pt_loc = unit_vector(pt_loc)
+    vort_loc = unit_vector(vort_loc)
+    #Find all my rotation matrices then rotate my system.
+    Ea, EaI, Eb, EbI = vort_frame(vort_loc)
+    pt1 = np.matmul(Ea, pt_loc)
     pt2 = np.matmul(Eb, pt1)
     #I have my point in my coord sys, now rotate it about z
     #b.c. z is the axis my vort is aligned w/.
@@ -165,24 +273,47 @@ def map_pt(pt_loc, vort_loc, dt, direct):
 
     return ptb
 
+def map_pts(pts, vort_loc, dt, direct):
+    '''
+    map_pt for a whole (N, 3) array of points in one go, returns the new
+    (N, 3) array. Each point gets its own Rodrigues rotation (by its own
+    u*dt) about the vortex axis, done array-wide.
+    '''
+    pts = np.asarray(pts, dtype = float)
+    pts = pts / np.linalg.norm(pts, axis = 1)[:, np.newaxis]
+    k, K, K2 = vort_axis(vort_loc)
+    cross = np.matmul(pts, K)
+    delta_angle = u_vals(pts, k, direct, cross)*dt
+    sin = np.sin(delta_angle)[:, np.newaxis]
+    vers = 2*np.sin(delta_angle/2)[:, np.newaxis]**2
+    return pts + sin*cross + vers*np.matmul(pts, K2)
+
 def to_spherical2(vect):
-    x = vect[0]
-    y = vect[1]
-    z = vect[2]
+    #One point, or an (N, 3) array of them - then it's an (N, 3) array back.
+    vect = np.asarray(vect, dtype = float)
+    x = vect[..., 0]
+    y = vect[..., 1]
+    z = vect[..., 2]
     XsqPlusYsq = x**2 + y**2
-    rho = math.sqrt(XsqPlusYsq + z**2)       
-    phi = math.atan2(z, math.sqrt(XsqPlusYsq))
-    theta = math.atan2(y, x)                           
-    return [rho, theta, phi]
+    rho = np.sqrt(XsqPlusYsq + z**2)       
+    phi = np.arctan2(z, np.sqrt(XsqPlusYsq))
+    theta = np.arctan2(y, x)                           
+    if vect.ndim == 1:
+        return [float(rho), float(theta), float(phi)]
+    return np.stack([rho, theta, phi], axis = -1)
 
 def to_cartesian(vect):
-    rho = vect[0]
-    theta = vect[1]
-    phi = vect[2]
-    x = rho*math.sin(phi)*math.cos(theta)
-    y = rho*math.sin(phi)*math.sin(theta)
-    z = rho*math.cos(phi)
-    return [x, y, z]
+    #One point, or an (N, 3) array of them - then it's an (N, 3) array back.
+    vect = np.asarray(vect, dtype = float)
+    rho = vect[..., 0]
+    theta = vect[..., 1]
+    phi = vect[..., 2]
+    x = rho*np.sin(phi)*np.cos(theta)
+    y = rho*np.sin(phi)*np.sin(theta)
+    z = rho*np.cos(phi)
+    if vect.ndim == 1:
+        return [float(x), float(y), float(z)]
+    return np.stack([x, y, z], axis = -1)
 
 #Euler angle's.
 def Ez(phi):
@@ -217,62 +348,102 @@ def test_mapping(vort):
     ax.scatter(a2, b2, c2, color = 'r')
     plt.show()    
 
+def test_map_pts(vort, n):
+    '''
+    Checks map_pts moves a set of points the same as map_pt does one at a
+    time. Prints the largest difference, which should be round off.
+    '''
+    pts = np.array(fibonacci_sphere(n, 11111))
+    one_at_a_time = np.array([map_pt(pt, vort, .5, 1) for pt in pts])
+    batch = map_pts(pts, vort, .5, 1)
+    print(np.abs(batch - one_at_a_time).max())
+
+def test_rodrigues(vort, n, steps):
+    '''
+    Checks the Rodrigues map_pt against the Euler frame one (map_pt_euler)
+    on n points. Prints the largest difference after one step, which is
+    round off, and after steps in a row, which grows as the flow is chaotic.
+    Then the time per step of each.
+    '''
+    pts = fibonacci_sphere(n, 11111)
+    one = max(mag(map_pt(pt, vort, .5, 1) - map_pt_euler(pt, vort, .5, 1)) \
+        for pt in pts)
+    new_pts = []
+    start = time.time()
+    for pt in pts:
+        for i in range(steps):
+            pt = map_pt(pt, vort, .5, 1)
+        new_pts.append(pt)
+    new_time = time.time() - start
+    old_pts = []
+    start = time.time()
+    for pt in pts:
+        for i in range(steps):
+            pt = map_pt_euler(pt, vort, .5, 1)
+        old_pts.append(pt)
+    old_time = time.time() - start
+    worst = np.abs(np.array(new_pts) - np.array(old_pts)).max()
+    print("1 step:", one, " ", steps, "steps:", worst)
+    print("Rodrigues", new_time/(n*steps), "s/step, Euler", \
+        old_time/(n*steps), "s/step")
+
+def test_core_accuracy(vort, dt):
+    '''
+    How accurate a step is near the vortex core. For points at a range of
+    distances from the vortex prints the error in the step's rotation angle
+    u*dt (against long double) with the old arccos distance and with the
+    atan2 one map_pts uses, and how far one step is from 100 sub-steps
+    (round off only - sub-stepping doesn't help as the step is an exact
+    rotation). The sub-steps a 0.1 radian limit would have cost are the
+    last column.
+    '''
+    k = unit_vector(np.asarray(vort, dtype = float))
+    e1, e2 = tangent_basis(k[np.newaxis])
+    print("dist, arccos angle err, atan2 angle err, 1 vs 100 steps, sub-steps")
+    for d in [1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7]:
+        pt = np.cos(d)*k + np.sin(d)*e1[0]
+        ptl = pt.astype(np.longdouble)
+        kl = k.astype(np.longdouble)
+        exact = np.arctan2(np.sqrt(np.sum(np.cross(ptl, kl)**2)), np.dot(ptl, kl))
+        old = np.arccos(np.clip(np.dot(pt, k), -1.0, 1.0))
+        new = 1 / u_vals(pt[np.newaxis], k, 1)[0]
+        one = map_pts(pt[np.newaxis], k, dt, 1)
+        many = pt[np.newaxis]
+        for i in range(100):
+            many = map_pts(many, k, dt/100, 1)
+        print(d, float(abs(dt/old - dt/exact)), float(abs(dt/new - dt/exact)), \
+            np.abs(one - many).max(), math.ceil(dt/new/0.1))
+
 def patch(n, seed):
     '''
     Generates a patch of points within preset theta & phi bounds.
     Useful to have the exact same patch sometimes, as chaotic dynamics
     makes it so tiny changes can have a huge impact.
     '''
-    points = fibonacci_sphere(n, seed)
-    patch_pts = []
-    for point in points:
-        sph_pt = to_spherical2(point)
-        theta = sph_pt[1]
-        phi = sph_pt[2]
-        if theta < 1.2 and theta > 0.8:
-            if phi < 1.2 and phi > 0.8:
-                if point[0] > 0:
-                    patch_pts.append(point)
-    return patch_pts
+    return patch2(n, seed, 0.8, 1.2, 0.8, 1.2)
 
 def patch2(n, seed, theta_mi, theta_ma, phi_mi, phi_ma):
     '''
     Generates a patch of points within given theta & phi bounds.
+    (window_sphere makes points in the same region without the waste.)
     '''
-    points = fibonacci_sphere(n, seed)
-    patch_pts = []
-    for point in points:
-        sph_pt = to_spherical2(point)
-        theta = sph_pt[1]
-        phi = sph_pt[2]
-        if ((theta < theta_ma) and (theta > theta_mi)):
-            #print("one pt")
-            #print(phi)
-            if phi < phi_ma and phi > phi_mi:
-                #print("one pt")
-                if point[0] > 0:
-                    patch_pts.append(point)
-    return patch_pts
+    return patch3(fibonacci_sphere(n, seed), theta_mi, theta_ma, \
+        phi_mi, phi_ma)
 
 def patch3(pts, theta_mi, theta_ma, phi_mi, phi_ma):
     '''
     Takes a patch of points and narrows it to be within 
-    given theta & phi bounds.
-    '''
-    points = pts
-    patch_pts = []
-    for point in points:
-        sph_pt = to_spherical2(point)
-        theta = sph_pt[1]
-        phi = sph_pt[2]
-        if ((theta < theta_ma) and (theta > theta_mi)):
-            #print("one pt")
-            #print(phi)
-            if phi < phi_ma and phi > phi_mi:
-                #print("one pt")
-                if point[0] > 0:
-                    patch_pts.append(point)
-    return patch_pts
+    given theta & phi bounds. Returns an (N, 3) array.
+    '''
+    points = np.asarray(pts, dtype = float)
+    if len(points) == 0:
+        return np.empty((0, 3))
+    sph_pts = to_spherical2(points)
+    theta = sph_pts[:, 1]
+    phi = sph_pts[:, 2]
+    inside = (theta < theta_ma) & (theta > theta_mi) & \
+        (phi < phi_ma) & (phi > phi_mi) & (points[:, 0] > 0)
+    return points[inside]
 
 #Could easily combine patch 1, 2, and 3 by using some optional arguements, 
 #and if not given then use other things.
@@ -310,33 +481,91 @@ def arc(vort):
     ax.scatter(a2, b2, c2, color = 'r')
     plt.show() 
 
-def path_line(vort1, vort2, init_pt, N, T):
+class trajectory:
     '''
-    Takes a SINGLE point and maps its path around two vortexs, in step size N
-    over time T.
+    Records the path of n points to a .npy file of shape (records, n, 3),
+    with the record of every stride'th step. Records collect in a buffer
+    of at most buffer_bytes (at least one record) that's written out when
+    full, so memory stays the same however long the path is or however
+    many points there are. float32 halves the file, float64 keeps every
+    digit.
+
+    Read it back with read_trajectory, which memory maps it so only the
+    parts looked at get loaded.
+    '''
+
+    def __init__(self, path, n, steps, stride = 1, buffer_bytes = 2**24, \
+        dtype = np.float32):
+        #steps is the number of steps after the first points.
+        self.path = path
+        self.stride = stride
+        self.records = steps // stride + 1
+        self.out = np.lib.format.open_memmap(path, mode = 'w+', \
+            dtype = dtype, shape = (self.records, n, 3))
+        chunk = max(1, buffer_bytes // (n * 3 * np.dtype(dtype).itemsize))
+        self.buffer = np.empty((min(chunk, self.records), n, 3), dtype = dtype)
+        self.filled = 0 #Records in the buffer.
+        self.written = 0 #Records in the file.
+        self.step = 0
+
+    def add(self, pts):
+        #The points after the next step, (n, 3), the first call is step 0.
+        if self.step % self.stride == 0:
+            self.buffer[self.filled] = pts
+            self.filled += 1
+            if self.filled == len(self.buffer):
+                self.flush()
+        self.step += 1
+
+    def flush(self):
+        self.out[self.written:self.written + self.filled] = \
+            self.buffer[:self.filled]
+        self.written += self.filled
+        self.filled = 0
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        del self.out
+
+def read_trajectory(path):
+    #A trajectory file as a read only memmap, (records, n, 3).
+    return np.load(path, mmap_mode = 'r')
+
+def record_path(vort1, vort2, init_pts, N, dt, T, path, stride = 1, \
+    buffer_bytes = 2**24, dtype = np.float32):
+    '''
+    Steps init_pts (a list or (n, 3) array) N times around the two
+    vortexs, recording the path to path (see trajectory). Returns it read
+    back with read_trajectory.
+
+    Pathlines keep their own vortex schedule on purpose: (t % 2*T) < T is
+    ((t % 2)*T) < T, so the vortexs switch every 1 time unit whatever T
+    is, not every T like advect (scatter). The path_line plots are of that
+    flow.
     '''
-    init_pt = unit_vector(init_pt)
     vort1 = unit_vector(vort1)
     vort2 = unit_vector(vort2)
-    #pts = fibonacci_sphere(1, 11111)
-    new_pts = [init_pt]
-    #pt = pts[0]
-    pt = init_pt
-    dt = T/10.0
+    pts = np.array([unit_vector(pt) for pt in init_pts], dtype = float)
+    recorder = trajectory(path, len(pts), N, stride, buffer_bytes, dtype)
+    recorder.add(pts)
     t = 0
     for i in range(N):
         if (t % 2*T) < T:
-            pt = map_pt(pt, vort1, dt, 1)
-            new_pts.append(pt)
+            vort = vort1
+        else:
+            vort = vort2
+        if len(pts) == 1:
+            pts[0] = map_pt(pts[0], vort, dt, 1) #Quicker for just the one.
         else:
-            pt = map_pt(pt, vort2, dt, 1)
-            new_pts.append(pt)
+            pts = map_pts(pts, vort, dt, 1)
+        recorder.add(pts)
         t += dt
-    fig = plt.figure()
-    ax = fig.gca(projection='3d')
-    #Get rid of the first few points b.c. they don't indiciate long term behaviour.
-    new_pts = new_pts[150:]
-    a3, b3, c3 = into_3(new_pts)
+    recorder.close()
+    return read_trajectory(path)
+
+def plot_vorts(ax, vort1, vort2):
+    #Draw the two vortexs as arrows, and the sphere behind.
     vort1 = list(vort1)
     vort2 = list(vort2)
     #Collect the vortex info to graph them.
@@ -349,11 +578,7 @@ def path_line(vort1, vort2, init_pt, N, T):
     xs = [a1, a2]
     ys = [b1, b2]
     zs = [c1, c2]
-    #Graph the vortexs, the starting point, then the path taken.
     ax.quiver(xs, ys, zs, xs, ys, zs, pivot = 'tail', linewidth = 3)
-    ax.scatter(init_pt[0], init_pt[1], init_pt[2], color = 'c')
-    ax.scatter(a3, b3, c3, color = 'r', s = 1)
-    
     #Background Sphere data
     u = np.linspace(0, 2 * np.pi, 200)
     v = np.linspace(0, np.pi, 200)
@@ -363,67 +588,333 @@ def path_line(vort1, vort2, init_pt, N, T):
 
     # Plot the surface
     ax.plot_surface(x, y, z, color='palegreen')
-    plt.show()
-
 
-def path_line2(vort1, vort2, init_pts, N, T):
+def path_line(vort1, vort2, init_pt, N, T, path = None, stride = 1):
+    '''
+    Takes a SINGLE point and maps its path around two vortexs, in step size N
+    over time T. The path is recorded to path (a temporary file if None,
+    removed after) - see record_path - with every stride'th step plotted.
+    '''
+    init_pt = unit_vector(init_pt)
+    keep = path is not None
+    if not keep:
+        fd, path = tempfile.mkstemp(suffix = '.npy')
+        os.close(fd)
+    dt = T/10.0
+    try:
+        new_pts = record_path(vort1, vort2, [init_pt], N, dt, T, path, stride)
+        fig = plt.figure()
+        ax = fig.gca(projection='3d')
+        #Get rid of the first few points b.c. they don't indiciate long term behaviour.
+        a3, b3, c3 = new_pts[-(-150 // stride):, 0].T
+        #Graph the vortexs, the starting point, then the path taken.
+        ax.scatter(init_pt[0], init_pt[1], init_pt[2], color = 'c')
+        ax.scatter(a3, b3, c3, color = 'r', s = 1)
+        plot_vorts(ax, unit_vector(vort1), unit_vector(vort2))
+        plt.show()
+    finally:
+        new_pts = None
+        if not keep and os.path.exists(path):
+            os.remove(path)
+
+
+def path_line2(vort1, vort2, init_pts, N, T, path = None, stride = 1):
     '''
     Takes a series of points, and effectively opperates path line on all of them.
     '''
-    vort1 = unit_vector(vort1)
-    vort2 = unit_vector(vort2)
-    #pts = fibonacci_sphere(1, 11111)
-    new_pts = []
-    for i in range(len(init_pts)):
-        new_pts.append([])
+    keep = path is not None
+    if not keep:
+        fd, path = tempfile.mkstemp(suffix = '.npy')
+        os.close(fd)
     dt = T/30.0
-    for j in range(len(init_pts)):
-        pt = init_pts[j]
-        pt = unit_vector(pt)
-        t = 0
-        new_pts_sublst = new_pts[j]
-        for i in range(N):
-            if (t % 2*T) < T:
-                pt = map_pt(pt, vort1, dt, 1)
-                new_pts_sublst.append(pt)
+    try:
+        new_pts = record_path(vort1, vort2, init_pts, N, dt, T, path, stride)
+        fig = plt.figure()
+        ax = fig.gca(projection='3d')
+        for j in range(len(init_pts)):
+            sublst = new_pts[-(-150 // stride):, j]
+            a3, b3, c3 = sublst.T
+            ax.scatter(a3, b3, c3, color = 'r', marker = '.')
+        plot_vorts(ax, unit_vector(vort1), unit_vector(vort2))
+        plt.show()
+    finally:
+        new_pts = None
+        if not keep and os.path.exists(path):
+            os.remove(path)
+
+def advect(pts, vort1, vort2, dt, T, steps, t = 0):
+    '''
+    Moves an (n, 3) array of points steps time steps of dt, with vort1 on
+    for the first T of every 2T and vort2 for the rest, starting at time t.
+    Every point is itterated together, one map_pts call per step.
+
+    While one vortex is on, a step is an exact rotation about it (the
+    distance to the vortex, so u, doesn't change) - splitting it up gains
+    nothing, even near the core. The only error is at the switches, so a
+    step that runs over one is split there, and any dt works, not just
+    ones that divide T.
+
+    Returns the points and the time after the last step - carrying that t
+    on to the next call makes a run in pieces the same as one long one.
+    '''
+    eps = 1e-9*dt #Round off in t, less than this is nothing.
+    for i in range(steps):
+        done = 0 #How much of this step is done.
+        while dt - done > eps:
+            r = (t + done) % (2*T)
+            first = r < T
+            to_switch = T - r
+            if not first:
+                to_switch = 2*T - r
+            if to_switch < eps:
+                #Round off left t just short of a switch.
+                first = not first
+                to_switch += T
+            sub = dt - done
+            if sub - to_switch > eps:
+                sub = to_switch
+            if first:
+                pts = map_pts(pts, vort1, sub, 1)
             else:
-                pt = map_pt(pt, vort2, dt, 1)
-                new_pts_sublst.append(pt)
-            t += dt
-    fig = plt.figure()
-    ax = fig.gca(projection='3d')
-    for j in range(len(new_pts)):
-        sublst = new_pts[j]
-        sublst = sublst[150:]
-        a3, b3, c3 = into_3(sublst)
-        ax.scatter(a3, b3, c3, color = 'r', marker = '.')
-    vort1 = list(vort1)
-    vort2 = list(vort2)
-    #Collect the vortex info to graph them.
-    a1 = vort1[0]
-    b1 = vort1[1]
-    c1 = vort1[2]
-    a2 = vort2[0]
-    b2 = vort2[1]
-    c2 = vort2[2]
-    xs = [a1, a2]
-    ys = [b1, b2]
-    zs = [c1, c2]
-    ax.quiver(xs, ys, zs, xs, ys, zs, pivot = 'tail', linewidth = 3)
-    #Background Sphere data
-    u = np.linspace(0, 2 * np.pi, 200)
-    v = np.linspace(0, np.pi, 200)
-    x = .97 * np.outer(np.cos(u), np.sin(v))
-    y = .97 * np.outer(np.sin(u), np.sin(v))
-    z = .97 * np.outer(np.ones(np.size(u)), np.cos(v))
+                pts = map_pts(pts, vort2, sub, 1)
+            done += sub
+        t += dt
+    return pts, t
 
-    # Plot the surface
-    ax.plot_surface(x, y, z, color='palegreen')
+#Worker processes' view of the shared particle array, see scatter_pts.
+shared_block = None
+shared_pts = None
+
+def init_shared(name, shape):
+    global shared_block, shared_pts
+    shared_block = shared_memory.SharedMemory(name = name)
+    shared_pts = np.ndarray(shape, dtype = float, buffer = shared_block.buf)
+
+def advect_shard(task):
+    #Advect rows start:stop of the shared array in place.
+    start, stop, vort1, vort2, dt, T, steps = task
+    shared_pts[start:stop] = advect(shared_pts[start:stop], vort1, vort2, \
+        dt, T, steps)[0]
+    return stop - start
+
+def scatter_pts(vort1, vort2, pts, N, T, a = 2.0, workers = 1, chunk = None):
+    '''
+    Where a blob of pts ends up after N time cycles, a steps per T, as an
+    (n, 3) array in the same order.
+
+    Particles don't affect each other, so with workers > 1 the blob is
+    split into shards of chunk points (default 4 per worker) that a process
+    pool advects. The points live in one shared memory array that the
+    workers update in place, so nothing but the shard bounds is pickled.
+    '''
+    pts = np.array(pts, dtype = float)
+    dt = T/a
+    M = int(N*a) #number of itterations necessary to do N time cycles.
+    if workers <= 1 or len(pts) < 2:
+        return advect(pts, vort1, vort2, dt, T, M)[0]
+    if chunk is None:
+        chunk = max(1, -(-len(pts) // (4*workers)))
+    block = shared_memory.SharedMemory(create = True, size = pts.nbytes)
+    try:
+        shared = np.ndarray(pts.shape, dtype = float, buffer = block.buf)
+        shared[:] = pts
+        tasks = [(i, min(i + chunk, len(pts)), vort1, vort2, dt, T, M) \
+            for i in range(0, len(pts), chunk)]
+        #The pool's gone before the block is unlinked, even on an error.
+        with multiprocessing.Pool(workers, init_shared, \
+            (block.name, pts.shape)) as pool:
+            pool.map(advect_shard, tasks, chunksize = 1)
+        end_pts = shared.copy()
+        del shared
+    finally:
+        block.close()
+        block.unlink()
+    return end_pts
+
+def sphere_bins(pts, n_z = 20, n_lon = 40):
+    '''
+    Which of n_z * n_lon equal area bins each (unit) point is in. The bins
+    are even steps in z and in longitude - on a sphere the area between
+    two heights only depends on the gap (Archimedes), so they're all the
+    same size.
+    '''
+    z_bin = np.floor((pts[:, 2] + 1) / 2 * n_z).astype(int)
+    lon = np.arctan2(pts[:, 1], pts[:, 0])
+    lon_bin = np.floor((lon + np.pi) / (2*np.pi) * n_lon).astype(int)
+    return np.clip(z_bin, 0, n_z - 1) * n_lon + np.clip(lon_bin, 0, n_lon - 1)
+
+def mixing_metrics(pts, n_z = 20, n_lon = 40):
+    '''
+    How well mixed a blob is, from how many of its points are in each of
+    the sphere_bins:
+        entropy - of the bin occupancy, over its max (log of the bins), so
+            0 is all in one bin and 1 is spread perfectly evenly.
+        variance - of the concentration (points in a bin over the mean
+            per bin). Falls towards bins/points (counting noise) as it mixes.
+        coverage - fraction of bins with any points in.
+    Only needs the bin counts, so no memory beyond the points themselves.
+    '''
+    n_bins = n_z * n_lon
+    counts = np.bincount(sphere_bins(pts, n_z, n_lon), minlength = n_bins)
+    p = counts[counts > 0] / float(len(pts))
+    concentration = counts * n_bins / float(len(pts))
+    return {'entropy': float(-np.sum(p * np.log(p)) / np.log(n_bins)),
+            'variance': float(concentration.var()),
+            'coverage': float(np.count_nonzero(counts) / float(n_bins))}
+
+def scatter_mixing(vort1, vort2, pts, N, T, a = 2.0, every = 10, \
+    bins = (20, 40), tol = None, patience = 3):
+    '''
+    scatter_pts that also measures the mixing (mixing_metrics) every every
+    steps as it goes. With tol it stops early once the entropy has changed
+    by less than tol for patience measurements in a row - it's saturated.
+
+    Returns the end points and the time series, a list of dicts of the
+    metrics with the step and time of each.
+    '''
+    pts = np.array(pts, dtype = float)
+    dt = T/a
+    M = int(N*a) #number of itterations necessary to do N time cycles.
+    step = 0
+    t = 0
+    series = [dict(mixing_metrics(pts, *bins), step = 0, t = 0)]
+    still = 0
+    while step < M:
+        steps = min(every, M - step)
+        pts, t = advect(pts, vort1, vort2, dt, T, steps, t)
+        step += steps
+        series.append(dict(mixing_metrics(pts, *bins), step = step, t = t))
+        if tol is not None:
+            if abs(series[-1]['entropy'] - series[-2]['entropy']) < tol:
+                still += 1
+            else:
+                still = 0
+            if still >= patience:
+                break
+    return pts, series
+
+def scatter_checkpointed(path, vort1, vort2, pts, N, T, a = 2.0, every = 100):
+    '''
+    scatter_pts for runs that may get killed part way. Every every steps
+    the points are saved to path.0.npy or path.1.npy (memory-mapped, the
+    two take turns) and the step, time and parameters to path.json, which
+    names the file holding the latest points. The sidecar is swapped in
+    whole only once the new points are on disk, so a kill at any moment
+    still leaves the last checkpoint whole. Carry on with resume_scatter.
+    '''
+    pts = np.array(pts, dtype = float)
+    state = {'vort1': [float(c) for c in vort1],
+             'vort2': [float(c) for c in vort2],
+             'N': N, 'T': T, 'a': a, 'every': every, 'n': len(pts),
+             'step': 0, 't': 0, 'slot': None}
+    return run_checkpointed(path, state, pts)
+
+def resume_scatter(path):
+    '''
+    Carries on a scatter_checkpointed run from its last checkpoint, exactly
+    as if it was never stopped. Returns the end points.
+    '''
+    with open(path + '.json') as f:
+        state = json.load(f)
+    pts = np.array(np.load(path + '.' + str(state['slot']) + '.npy'))
+    return run_checkpointed(path, state, pts)
+
+def run_checkpointed(path, state, pts):
+    #The advection loop of scatter_checkpointed/resume_scatter.
+    T = state['T']
+    dt = T/state['a']
+    M = int(state['N']*state['a'])
+    vort1 = np.array(state['vort1'])
+    vort2 = np.array(state['vort2'])
+    while state['step'] < M:
+        steps = min(state['every'], M - state['step'])
+        pts, state['t'] = advect(pts, vort1, vort2, dt, T, steps, state['t'])
+        state['step'] += steps
+        #Write the slot the sidecar isn't pointing at.
+        slot = 0
+        if state['slot'] == 0:
+            slot = 1
+        saved = np.lib.format.open_memmap(path + '.' + str(slot) + '.npy', \
+            mode = 'w+', dtype = float, shape = pts.shape)
+        saved[:] = pts
+        saved.flush()
+        del saved
+        state['slot'] = slot
+        #json keeps floats exactly, so the resumed t is the same t.
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.json.tmp', path + '.json')
+    return pts
+
+def tangent_basis(pts):
+    #Two unit vectors tangent to the sphere at each point, at right angles.
+    ref = np.zeros_like(pts)
+    ref[:, 2] = 1
+    #Near the poles z is almost along the point, use x there.
+    polar = np.abs(pts[:, 2]) > 0.9
+    ref[polar] = [1, 0, 0]
+    e1 = np.cross(ref, pts)
+    e1 /= np.linalg.norm(e1, axis = 1)[:, np.newaxis]
+    e2 = np.cross(pts, e1)
+    return e1, e2
+
+def ftle_field(vort1, vort2, n, N, T, a = 2.0, eps = 1e-7, seed = 1, \
+    batch = 100000, workers = 1, chunk = None):
+    '''
+    Finite time Lyapunov exponents over the sphere - how fast the flow
+    stretches things apart near each of n fibonacci_sphere seeds, over N
+    time cycles. Big values are the chaotic regions.
+
+    Every seed gets four neighbours eps away along two tangent directions,
+    and all of them are advected together (scatter_pts, so workers > 1
+    shares them out over processes), batch seeds at a time to keep memory
+    down. The neighbours' spread gives the flow's stretching (its Cauchy
+    Green tensor) and the FTLE is the log of its biggest stretch over the
+    time taken.
+
+    Returns the (n, 3) seeds and the (n,) FTLEs.
+    '''
+    seeds = np.array(fibonacci_sphere(n, seed))
+    ftle = np.empty(n)
+    elapsed = int(N*a) * (T/a)
+    for start in range(0, n, batch):
+        pts = seeds[start:start + batch]
+        e1, e2 = tangent_basis(pts)
+        #Neighbours +e1, -e1, +e2, -e2, all advected as one blob.
+        blob = np.concatenate([pts + eps*e1, pts - eps*e1, \
+            pts + eps*e2, pts - eps*e2])
+        blob = scatter_pts(vort1, vort2, blob, N, T, a, workers, chunk)
+        m = len(pts)
+        d1 = (blob[:m] - blob[m:2*m]) / (2*eps)
+        d2 = (blob[2*m:3*m] - blob[3*m:]) / (2*eps)
+        #Biggest eigenvalue of the 2x2 Cauchy Green tensor [[a, b], [b, c]].
+        c11 = np.sum(d1*d1, axis = 1)
+        c12 = np.sum(d1*d2, axis = 1)
+        c22 = np.sum(d2*d2, axis = 1)
+        lam = (c11 + c22)/2 + np.sqrt(((c11 - c22)/2)**2 + c12**2)
+        ftle[start:start + m] = np.log(lam) / (2*elapsed)
+    return seeds, ftle
+
+def save_ftle(path, seeds, ftle):
+    np.savez(path, seeds = seeds, ftle = ftle)
+
+def plot_ftle(seeds, ftle):
+    #The FTLE field as a longitude/latitude map.
+    lon = np.arctan2(seeds[:, 1], seeds[:, 0])
+    lat = np.arcsin(np.clip(seeds[:, 2], -1, 1))
+    plt.figure()
+    plt.scatter(lon, lat, c = ftle, s = 2, cmap = 'inferno')
+    plt.colorbar(label = 'FTLE')
+    plt.xlabel('longitude')
+    plt.ylabel('latitude')
     plt.show()
 
-def scatter(vort1, vort2, pts, N, T):
+def scatter(vort1, vort2, pts, N, T, workers = 1, chunk = None):
     '''
-    Shows how a blob evolves in time.
+    Shows how a blob evolves in time. workers > 1 spreads the work over
+    that many processes (see scatter_pts).
     '''
     a = 2.0 #T step size
     start = time.time()
@@ -433,32 +924,14 @@ def scatter(vort1, vort2, pts, N, T):
     vxn = [vort1[0]/mag(vort1), vort2[0]/mag(vort2)]
     vyn = [vort1[1]/mag(vort1), vort2[1]/mag(vort2)]
     vzn = [vort1[2]/mag(vort1), vort2[2]/mag(vort2)]
-    end_pts = []
-    dt = T/a
-    M = int(N*a) #number of itterations necessary to do N time cycles.
-    #For each point
-    for pt in pts:
-        #itterate it N times
-        c1 = 0
-        c2 = 0
-        t = 0
-        for i in range(M):
-            if (t % (2*T)) < T:
-                pt = map_pt(pt, vort1, dt, 1)
-                c1 += 1
-            else:
-                pt = map_pt(pt, vort2, dt, 1)
-                c2 += 1
-            #If its the last point, add it to the map.
-            if i == (M - 1):
-                end_pts.append(pt)
-            t += dt
+    pts = np.asarray(pts, dtype = float)
+    end_pts = scatter_pts(vort1, vort2, pts, N, T, a, workers, chunk)
     fig = plt.figure()
     ax = fig.gca(projection='3d')
-    a3, b3, c3 = into_3(end_pts)
+    a3, b3, c3 = end_pts.T
     ax.quiver(vxn, vyn, vzn, vx, vy, vz, pivot = 'tail', linewidth = 3)
     ax.set_aspect("equal")
-    a2, b2, c2 = into_3(pts)
+    a2, b2, c2 = pts.T
     ax.scatter(a2, b2, c2, color = 'r', zorder = 1, marker = '.', s = 1)
     #ax.plot_wireframe(x, y, z, color="r", zorder = 2)
     #End pts
@@ -491,22 +964,23 @@ def BetaGamma(B, G):
     v2 = np.matmul(Ea, v2)
     return v1, v2
 
-    
-v1, v2 = BetaGamma(np.pi/2, 0.5)
-#path_line2(v1, v2, [[1, 1, 0], [1, 0, 1], [0, 1, 1], [2, 0, 2]], 2000, 1)
-path_line(v1, v2, [1, 1, 0], 10000, 0.05)
 
-'''
-#theta min, ma, phi mi, ma
-t_mi = 0
-t_ma = 0.4
-p_ma = np.pi/4 + 0.2
-p_mi = np.pi/4 - 0.2
-
-pts = fibonacci_sphere(10000, 22222)
-patches = patch2(200000, 22222, t_mi, t_ma, p_mi, p_ma)
-scatter(v1, v2, patches, 200, 2)
-'''
+if __name__ == "__main__":
+    v1, v2 = BetaGamma(np.pi/2, 0.5)
+    #path_line2(v1, v2, [[1, 1, 0], [1, 0, 1], [0, 1, 1], [2, 0, 2]], 2000, 1)
+    path_line(v1, v2, [1, 1, 0], 10000, 0.05)
+
+    '''
+    #theta min, ma, phi mi, ma
+    t_mi = 0
+    t_ma = 0.4
+    p_ma = np.pi/4 + 0.2
+    p_mi = np.pi/4 - 0.2
+
+    pts = fibonacci_sphere(10000, 22222)
+    patches = patch2(200000, 22222, t_mi, t_ma, p_mi, p_ma)
+    scatter(v1, v2, patches, 200, 2)
+    '''
 
 
 
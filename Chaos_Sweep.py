@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from Chaos_Project import BetaGamma, patch2, scatter_pts
+
+'''
+Parameter sweeps of the two vortex mixing over the BetaGamma(B, G) plane,
+the period T and the number of cycles N.
+
+Every (B, G, T, N) in the grid is a headless scatter of the same starting
+blob, run across a process pool. Each result - the blob's end points and
+the parameters - is saved in the cache directory under a hash of all the
+parameters that change it (the seed and blob included), so rerunning a
+sweep, or a bigger one overlapping it, only runs the configurations that
+aren't there yet.
+
+Example - 4 x 3 x 2 grid at 50 cycles each:
+    python Chaos_Sweep.py --B 0.5 1.0 1.5 2.0 --G 0.25 0.5 1.0 --T 1 2 \
+        --N 50 --cache sweep_cache
+'''
+
+version = 2 #Bump if a change to the simulation changes results.
+
+
+def config_key(config):
+    #Hash of everything that changes a run's result, names its cache file.
+    text = json.dumps(dict(config, version = version), sort_keys = True)
+    return hashlib.sha1(text.encode()).hexdigest()[:20]
+
+def cache_path(cache, config):
+    return os.path.join(cache, config_key(config) + '.npz')
+
+def load_result(cache, config):
+    #End points of a cached run (an (n, 3) array), None if it's not cached.
+    path = cache_path(cache, config)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)['end_pts']
+
+def run_config(task):
+    '''
+    One configuration, in a worker process. Saves to the cache (written to
+    a temporary file first, so a killed sweep never leaves half a result)
+    and returns the config and how long it took.
+    '''
+    cache, config = task
+    start = time.time()
+    v1, v2 = BetaGamma(config['B'], config['G'])
+    pts = np.array(patch2(config['samples'], config['seed'], \
+        *config['window']))
+    end_pts = scatter_pts(v1, v2, pts, config['N'], config['T'], config['a'])
+    path = cache_path(cache, config)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, start_pts = pts, end_pts = end_pts, \
+        config = json.dumps(config, sort_keys = True))
+    os.replace(tmp, path)
+    return config, time.time() - start
+
+def make_grid(Bs, Gs, Ts, Ns, seed = 22222, samples = 200000, \
+    window = (0, 0.4, np.pi/4 - 0.2, np.pi/4 + 0.2), a = 2.0):
+    #Every (B, G, T, N) combination, as config dicts.
+    grid = []
+    for B, G, T, N in itertools.product(Bs, Gs, Ts, Ns):
+        grid.append({'B': float(B), 'G': float(G), 'T': float(T), 'N': int(N),
+                     'a': float(a), 'seed': seed, 'samples': samples,
+                     'window': [float(w) for w in window]})
+    return grid
+
+def sweep(grid, cache, workers = None):
+    '''
+    Run every config in grid that isn't in cache yet, over workers
+    processes (None for one per core). Returns the number that were run.
+    '''
+    os.makedirs(cache, exist_ok = True)
+    missing = [config for config in grid \
+        if not os.path.exists(cache_path(cache, config))]
+    print(len(grid) - len(missing), "of", len(grid), "configurations cached,", \
+        "running", len(missing))
+    if len(missing) == 0:
+        return 0
+    pool = multiprocessing.Pool(workers)
+    tasks = [(cache, config) for config in missing]
+    for done, (config, secs) in enumerate( \
+        pool.imap_unordered(run_config, tasks), 1):
+        print(done, "/", len(missing), "B", config['B'], "G", config['G'], \
+            "T", config['T'], "N", config['N'], "-", round(secs, 1), "s")
+    pool.close()
+    pool.join()
+    return len(missing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = \
+        "Sweep the two vortex mixing over B, G, T and N.")
+    parser.add_argument("--B", type = float, nargs = "+", default = [np.pi/2], \
+        help = "angles between the vortexs")
+    parser.add_argument("--G", type = float, nargs = "+", default = [0.5], \
+        help = "vortex strength scales")
+    parser.add_argument("--T", type = float, nargs = "+", default = [2.0], \
+        help = "times each vortex is on for")
+    parser.add_argument("--N", type = int, nargs = "+", default = [200], \
+        help = "time cycles to run")
+    parser.add_argument("--seed", type = int, default = 22222)
+    parser.add_argument("--samples", type = int, default = 200000, \
+        help = "fibonacci_sphere points the blob is cut from")
+    parser.add_argument("--window", type = float, nargs = 4, \
+        default = [0, 0.4, np.pi/4 - 0.2, np.pi/4 + 0.2], \
+        help = "blob's theta min, max, phi min, max")
+    parser.add_argument("--cache", default = "sweep_cache", \
+        help = "directory results are kept in")
+    parser.add_argument("--workers", type = int, default = None, \
+        help = "worker processes, default one per core")
+    args = parser.parse_args()
+    start = time.time()
+    grid = make_grid(args.B, args.G, args.T, args.N, args.seed, \
+        args.samples, args.window)
+    sweep(grid, args.cache, args.workers)
+    print("Took", round(time.time() - start, 1), "s")
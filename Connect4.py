@@ -2,27 +2,963 @@
 
 import tkinter as tk #tkinter as of python3, Tkinter in python2.
 import numpy as np
+import collections
+import math
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+
+class bit_board:
+    '''
+    Headless Connect 4 game state stored as two integer bitboards, one per
+    player (indexed by player value 1 or 2, index 0 is unused). Any board
+    size works, and k in a row wins (Connect-K) - Python ints are as wide
+    as they need to be, so a 20x20 board is just a 420 bit int.
+
+    Each column takes size_y + 1 bits, bottom row first, with one spare
+    sentinel bit on top that is never set - it stops runs/wins from wrapping
+    over into the next column. Grid coordinates (i, j) match connect_four:
+    i is the column, j the row with 0 at the top, so chips fill from
+    j = size_y - 1 upwards.
+
+    hash is a Zobrist hash of the position, updated on every make/unmake.
+    The keys come from a fixed seed so hashes are the same in every process.
+
+    runs is a threat map: runs[player][d][index] is how many of player's
+    chips are in a row starting next to that cell along half line d (down,
+    then both ways along the horizontal and the two diagonals), capped at
+    run_limit (k - 1) as longer runs score and win the same. make/unmake only touch
+    the cells whose runs go through the changed one, so flexibility scores
+    and win checks are table lookups.
+
+    moves is the move stack. make/unmake are for searches, play/undo/redo
+    for real game moves - undone moves can be redone until a new one is
+    played. A game saves as a move string of 1-based columns, e.g. "4453",
+    with letters after 9 for wide boards (up to 35 columns). Player 1
+    always moves first.
+    '''
+
+    move_chars = '123456789abcdefghijklmnopqrstuvwxyz'
+
+    zobrist_tables = {} #Keys per board size, shared by all boards.
+
+    def __init__(self, size_x = 7, size_y = 6, k = 4):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.k = k
+        self.col_bits = size_y + 1 #Column height including the sentinel.
+        self.boards = [0, 0, 0]
+        #Index of the next free bit in each column.
+        self.heights = [i * self.col_bits for i in range(size_x)]
+        self.moves = [] #Stack of played columns, for unmake.
+        self.redo_moves = [] #Stack of undone (column, player)s.
+        #Shift per step for vertical, horizontal, diagonal1 and diagonal2.
+        self.shifts = (1, self.col_bits, self.col_bits - 1, self.col_bits + 1)
+        self.zobrist = self.zobrist_keys(size_x, size_y)
+        self.hash = 0
+        self.n_bits = size_x * self.col_bits
+        self.run_limit = k - 1
+        self.half_shifts = (-1, self.col_bits, -self.col_bits, \
+            self.col_bits - 1, 1 - self.col_bits, \
+            self.col_bits + 1, -1 - self.col_bits)
+        self.runs = [None]
+        for player in (1, 2):
+            self.runs.append([[0] * self.n_bits for s in self.half_shifts])
+
+    @classmethod
+    def zobrist_keys(cls, size_x, size_y):
+        #One random 64 bit key per player per bit, index 0 is unused.
+        if (size_x, size_y) not in cls.zobrist_tables:
+            rng = random.Random(4444)
+            n_bits = size_x * (size_y + 1)
+            keys = [None]
+            for player in (1, 2):
+                keys.append([rng.getrandbits(64) for b in range(n_bits)])
+            cls.zobrist_tables[(size_x, size_y)] = keys
+        return cls.zobrist_tables[(size_x, size_y)]
+
+    def copy(self):
+        other = bit_board(self.size_x, self.size_y, self.k)
+        other.boards = list(self.boards)
+        other.heights = list(self.heights)
+        other.moves = list(self.moves)
+        other.redo_moves = list(self.redo_moves)
+        other.hash = self.hash
+        for player in (1, 2):
+            other.runs[player] = [list(line) for line in self.runs[player]]
+        return other
+
+    def bit_index(self, i, j):
+        #Convert grid coordinates to a bit index.
+        return i * self.col_bits + (self.size_y - 1 - j)
+
+    def cell(self, i, j):
+        #Return the player value (0 for open) at a grid location.
+        bit = 1 << self.bit_index(i, j)
+        if self.boards[1] & bit:
+            return 1
+        elif self.boards[2] & bit:
+            return 2
+        return 0
+
+    def can_play(self, column):
+        return self.heights[column] < column * self.col_bits + self.size_y
+
+    def bottom_row(self, column):
+        #For a given column, the grid row a chip would land in, -1 if full.
+        if not self.can_play(column):
+            return -1
+        return self.size_y - 1 - (self.heights[column] - column * self.col_bits)
+
+    def legal_moves(self):
+        return [i for i in range(self.size_x) if self.can_play(i)]
+
+    def opens(self):
+        #Return a list of bottom spots that are open.
+        opens = []
+        for i in range(self.size_x):
+            if self.can_play(i):
+                opens.append((i, self.bottom_row(i)))
+        return opens
+
+    def make(self, column, player):
+        '''
+        Drop a chip for player into column. Returns the grid location it
+        landed on. The caller must check can_play first.
+        '''
+        j = self.bottom_row(column)
+        index = self.heights[column]
+        self.boards[player] |= 1 << index
+        self.hash ^= self.zobrist[player][index]
+        self.heights[column] += 1
+        self.moves.append(column)
+        self.update_runs(index, player)
+        return (column, j)
+
+    def unmake(self):
+        #Take back the last move, returns the column it was in.
+        column = self.moves.pop()
+        self.heights[column] -= 1
+        index = self.heights[column]
+        player = self.cell_player(index)
+        self.boards[player] &= ~(1 << index)
+        self.hash ^= self.zobrist[player][index]
+        self.update_runs(index, player)
+        return column
+
+    def play(self, column, player):
+        #make for a real game move, anything undone can't be redone after.
+        self.redo_moves = []
+        return self.make(column, player)
+
+    def undo(self):
+        #Take back the last game move so it can be redone. Returns its column.
+        column = self.moves[-1]
+        self.redo_moves.append((column, self.cell_player(self.heights[column] - 1)))
+        return self.unmake()
+
+    def redo(self):
+        #Replay the last undone move, returns the grid location like make.
+        column, player = self.redo_moves.pop()
+        return self.make(column, player)
+
+    def cell_player(self, index):
+        #Player whose chip is at bit index (an empty cell gives 1).
+        if self.boards[2] >> index & 1:
+            return 2
+        return 1
+
+    def next_player(self):
+        return 1 + len(self.moves) % 2
+
+    def to_moves(self):
+        #Move string for the game so far.
+        return ''.join(self.move_chars[column] for column in self.moves)
+
+    @classmethod
+    def from_moves(cls, moves, size_x = 7, size_y = 6, k = 4):
+        #New board with a move string played out, player 1 first.
+        board = cls(size_x, size_y, k)
+        player = 1
+        for char in moves.strip():
+            column = cls.move_chars.find(char.lower())
+            if column < 0 or column >= size_x or not board.can_play(column):
+                raise ValueError("Illegal move " + repr(char) + " in " + moves)
+            board.make(column, player)
+            player = 3 - player
+        return board
+
+    def update_runs(self, index, player):
+        '''
+        Fix player's threat map after the cell at bit index was filled or
+        emptied. Along each half line, walk back from the cell over player's
+        chips - those are the only runs that went through it.
+        '''
+        own = self.boards[player]
+        limit = self.run_limit
+        n_bits = self.n_bits
+        runs = self.runs[player]
+        for d, s in enumerate(self.half_shifts):
+            line = runs[d]
+            value = 0
+            if own >> index & 1:
+                value = line[index] + 1
+            x = index
+            for t in range(limit):
+                x -= s
+                if x < 0 or x >= n_bits:
+                    break
+                line[x] = min(value + t, limit)
+                if not own >> x & 1:
+                    break
+
+    def is_win(self, player):
+        '''
+        k in a row in any direction, found by shifting the board onto itself.
+        Each pass doubles the run length the mask stands for (1, 2, 4..), so
+        it's log(k) shifts per direction.
+        '''
+        b = self.boards[player]
+        for s in self.shifts:
+            m = b
+            length = 1
+            while length < self.k:
+                step = min(length, self.k - length)
+                m &= m >> (step * s)
+                length += step
+            if m:
+                return True
+        return False
+
+    def is_full(self):
+        return len(self.moves) == self.size_x * self.size_y
+
+    def to_array(self):
+        #The board as a (size_x, size_y) grid of player values, 0 for open.
+        n_bits = self.size_x * self.col_bits
+        n_bytes = (n_bits + 7) // 8
+        grid = np.zeros(n_bits, dtype = np.int8)
+        for player in (1, 2):
+            raw = np.frombuffer(self.boards[player].to_bytes(n_bytes, 'little'), \
+                dtype = np.uint8)
+            bits = np.unpackbits(raw, bitorder = 'little')[:n_bits]
+            grid += player * bits.astype(np.int8)
+        #Drop the sentinel row and flip so row 0 is the top.
+        grid = grid.reshape(self.size_x, self.col_bits)[:, self.size_y - 1::-1]
+        return np.ascontiguousarray(grid)
+
+    def run_counts(self, pos, player):
+        '''
+        Number of player chips in a row next to pos, for the vertical (only
+        below, as chips can't be above an open spot), horizontal and both
+        diagonal lines - the counts calc_flexibility scores. Each side is
+        capped at run_limit since longer runs all score the same.
+        '''
+        return self.index_counts(self.bit_index(*pos), player)
+
+    def index_counts(self, index, player):
+        runs = self.runs[player]
+        return [runs[0][index], runs[1][index] + runs[2][index], \
+            runs[3][index] + runs[4][index], runs[5][index] + runs[6][index]]
+
+    def wins_at(self, column, player):
+        #Would player win by dropping a chip in column? Needs can_play.
+        index = self.heights[column]
+        for count in self.index_counts(index, player):
+            if count >= self.run_limit:
+                return True
+        return False
+
+class trans_table:
+    '''
+    Fixed size transposition table for ai_search, keyed by bit_board.hash.
+
+    Entries live in preallocated NumPy arrays, so the memory used is set by
+    size_mb up front and never grows. A slot is picked by the low bits of
+    the hash, and the full hash is kept to spot collisions. When two
+    positions want the same slot the deeper search is kept (depth-preferred),
+    unless the old one is from an earlier game.
+
+    Stored values are bounds: exact, lower (the search failed high) or upper
+    (it failed low).
+    '''
+
+    exact = 1
+    lower = 2
+    upper = 3
+    #keys + values + depths + flags + moves + ages
+    entry_bytes = 8 + 8 + 2 + 1 + 1 + 1
+
+    def __init__(self, size_mb = 16):
+        n = 1
+        while 2 * n * self.entry_bytes <= size_mb * 2**20:
+            n *= 2
+        self.size = n
+        self.mask = n - 1
+        self.keys = np.zeros(n, dtype = np.uint64)
+        self.values = np.zeros(n, dtype = np.float64)
+        self.depths = np.zeros(n, dtype = np.int16)
+        self.flags = np.zeros(n, dtype = np.int8) #0 for an empty slot.
+        self.moves = np.zeros(n, dtype = np.int8)
+        self.ages = np.zeros(n, dtype = np.uint8)
+        self.age = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.filled = 0
+
+    def clear(self):
+        self.flags[:] = 0
+        self.age = 0
+        self.reset_counters()
+
+    def new_game(self, keep = False):
+        '''
+        Called between games. Clears the table unless keep, in which case
+        old entries stay usable but are the first to be replaced.
+        '''
+        if keep:
+            self.age = (self.age + 1) % 256
+        else:
+            self.clear()
+
+    def probe(self, key):
+        #Returns (depth, flag, value, move) stored for key, or None.
+        self.probes += 1
+        index = key & self.mask
+        if self.flags[index] and self.keys[index] == key:
+            self.hits += 1
+            return (int(self.depths[index]), int(self.flags[index]), \
+                float(self.values[index]), int(self.moves[index]))
+        return None
+
+    def store(self, key, depth, flag, value, move):
+        index = key & self.mask
+        if self.flags[index] == 0:
+            self.filled += 1
+        elif self.keys[index] != key and self.ages[index] == self.age \
+            and self.depths[index] > depth:
+            return #Keep the deeper result.
+        self.keys[index] = key
+        self.depths[index] = depth
+        self.flags[index] = flag
+        self.values[index] = value
+        self.moves[index] = move
+        self.ages[index] = self.age
+        self.stores += 1
+
+    def stats(self):
+        #Counters for sizing the table.
+        hit_rate = 0.0
+        if self.probes:
+            hit_rate = self.hits / float(self.probes)
+        return {'entries': self.size,
+                'size_mb': self.size * self.entry_bytes / 2.0**20,
+                'probes': self.probes,
+                'hits': self.hits,
+                'hit_rate': hit_rate,
+                'stores': self.stores,
+                'filled': self.filled,
+                'occupancy': self.filled / float(self.size)}
+
+class ai_search:
+    '''
+    Negamax search with alpha-beta pruning and iterative deepening. Moves
+    are tried center column first (and the previous iteration's best move
+    before that). Leaves are scored with the game's flexibility heuristic.
+
+    The search stops when either budget runs out - time_limit in seconds
+    or node_limit nodes, None for no limit - and then plays the best move
+    of the deepest fully searched depth.
+
+    Results are kept in a trans_table that lasts for the whole game. Pass
+    the same tt to several searches, with keep_tt, to share it across games.
+
+    Setting stop_event (a threading.Event) also ends the search early.
+    '''
+
+    win_score = 10**7 #Bigger than any flexibility score.
+
+    def __init__(self, game, time_limit = 1.0, node_limit = None, \
+        max_depth = None, tt = None, keep_tt = False):
+        self.game = game #connect_four whose heuristic scores the leaves.
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.max_depth = max_depth
+        if tt is None:
+            tt = trans_table()
+        self.tt = tt
+        self.keep_tt = keep_tt
+        self.stop_event = None
+        self.nodes = 0
+        self.depth = 0 #Deepest completed depth of the last search.
+        self.stopped = False
+
+    def new_game(self):
+        self.tt.new_game(self.keep_tt)
+
+    def move_order(self, board, first = None):
+        #Center column first, then working outwards. Optionally a move to try first.
+        center = (board.size_x - 1) / 2.0
+        moves = sorted(board.legal_moves(), key=lambda c: abs(c - center))
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def to_tt(self, score, ply):
+        #Win/loss scores count plies from the root, store them from this node.
+        if score > self.win_score - 1000:
+            return score + ply
+        elif score < -self.win_score + 1000:
+            return score - ply
+        return score
+
+    def from_tt(self, score, ply):
+        if score > self.win_score - 1000:
+            return score - ply
+        elif score < -self.win_score + 1000:
+            return score + ply
+        return score
+
+    def out_of_budget(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            return True
+        if self.stop_event is not None and self.stop_event.is_set():
+            return True
+        #Checking the clock every node is wasteful, so only every 64.
+        if self.time_limit is not None and (self.nodes & 63) == 0:
+            if time.perf_counter() - self.start >= self.time_limit:
+                return True
+        return False
+
+    def best_move(self, board, player):
+        '''
+        Search board for player to move. Returns a tuple of the best column
+        and its score (from player's point of view).
+        '''
+        self.start = time.perf_counter()
+        self.nodes = 0
+        self.depth = 0
+        self.stopped = False
+        moves = self.move_order(board)
+        best = (moves[0], 0)
+        max_depth = self.size_left(board)
+        if self.max_depth is not None:
+            max_depth = min(max_depth, self.max_depth)
+        for depth in range(1, max_depth + 1):
+            result = self.search_root(board, player, depth, moves)
+            if self.stopped:
+                break
+            best = result
+            self.depth = depth
+            #Try the best move first next iteration, it's the likely best again.
+            moves.remove(best[0])
+            moves.insert(0, best[0])
+            if abs(best[1]) >= self.win_score - board.size_x * board.size_y:
+                break #Forced win or loss found, deeper won't change it.
+        return best
+
+    def size_left(self, board):
+        return board.size_x * board.size_y - len(board.moves)
+
+    def search_root(self, board, player, depth, moves):
+        alpha = -self.win_score - 1
+        beta = self.win_score + 1
+        best = (moves[0], alpha)
+        for column in moves:
+            if board.wins_at(column, player):
+                score = self.win_score - 1
+            else:
+                board.make(column, player)
+                score = -self.negamax(board, 3 - player, depth - 1, \
+                    -beta, -alpha, 1)
+                board.unmake()
+            if self.stopped:
+                return best
+            if score > best[1]:
+                best = (column, score)
+            alpha = max(alpha, score)
+        self.tt.store(board.hash, depth, trans_table.exact, best[1], best[0])
+        return best
+
+    def negamax(self, board, player, depth, alpha, beta, ply):
+        #Score of board for player to move, the last move didn't win.
+        self.nodes += 1
+        if self.out_of_budget():
+            self.stopped = True
+            return 0
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.tt.probe(board.hash)
+        if entry is not None:
+            tt_depth, flag, value, tt_move = entry
+            if tt_depth >= depth:
+                value = self.from_tt(value, ply)
+                if flag == trans_table.exact:
+                    return value
+                elif flag == trans_table.lower:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+        moves = self.move_order(board, tt_move)
+        if len(moves) == 0:
+            return 0 #Draw, board is full.
+        #If any move wins then take it, no need to look further.
+        for column in moves:
+            if board.wins_at(column, player):
+                return self.win_score - ply - 1
+        if depth == 0:
+            return self.game.evaluate(board, player)
+        best = -self.win_score - 1
+        best_move = moves[0]
+        for column in moves:
+            board.make(column, player)
+            score = -self.negamax(board, 3 - player, depth - 1, \
+                -beta, -alpha, ply + 1)
+            board.unmake()
+            if self.stopped:
+                return 0
+            if score > best:
+                best = score
+                best_move = column
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+        if best <= alpha_orig:
+            flag = trans_table.upper
+        elif best >= beta:
+            flag = trans_table.lower
+        else:
+            flag = trans_table.exact
+        self.tt.store(board.hash, depth, flag, self.to_tt(best, ply), best_move)
+        return best
+
+class mcts_node:
+    #One position in the mcts_search tree, reached by player playing column.
+
+    def __init__(self, parent, column, player, untried, won = False):
+        self.parent = parent
+        self.column = column
+        self.player = player
+        self.untried = untried #Legal moves not yet expanded.
+        self.won = won #The move into this node won the game.
+        self.children = []
+        self.visits = 0
+        self.wins = 0.0 #For player, draws count a half.
+
+    def uct_child(self, c):
+        #The child to explore, by the UCT formula.
+        log_n = math.log(self.visits)
+        best = None
+        best_score = -1
+        for child in self.children:
+            score = child.wins / child.visits + \
+                c * math.sqrt(log_n / child.visits)
+            if score > best_score:
+                best = child
+                best_score = score
+        return best
+
+class mcts_search:
+    '''
+    Monte Carlo Tree Search (UCT). Each iteration walks down the tree,
+    expands one new move, plays the game out to the end and passes the
+    result back up. The move played most often at the root is picked.
+
+    Playouts ('rollout') are either 'random' or 'flex', where moves are
+    picked with odds weighted by calc_flexibility. Both always take a win
+    when one is there.
+
+    The budget is iterations per worker and/or time_limit seconds, with
+    default_iterations if neither is set (a search with no budget would
+    never end, pool workers have no stop_event). With more than one worker
+    the search is root-parallel: every worker process grows its own tree
+    from the same position (with its own seed) and the root visit counts
+    are added up, so strength scales with cores.
+
+    Setting stop_event (a threading.Event) ends a single process search
+    early, pool workers always use their whole budget.
+    '''
+
+    default_iterations = 10000 #When there's no other budget.
+
+    def __init__(self, game, iterations = None, time_limit = 1.0, \
+        workers = 1, rollout = 'random', c = 1.4, seed = None):
+        self.game = game #connect_four, for the 'flex' playouts.
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.workers = workers
+        self.rollout = rollout
+        self.c = c
+        self.rng = random.Random(seed)
+        self.pool = None
+        self.playouts = 0 #Iterations done in the last search, all workers.
+        self.stop_event = None
+
+    def best_move(self, board, player):
+        '''
+        Search board for player to move. Returns a tuple of the best column
+        and its win rate (draws count a half).
+        '''
+        if self.workers <= 1:
+            results = [self.grow_tree(board.copy(), player)]
+        else:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers)
+            tasks = []
+            for k in range(self.workers):
+                tasks.append((board, player, self.iterations, self.time_limit, \
+                    self.rollout, self.c, self.rng.getrandbits(32)))
+            results = self.pool.map(mcts_worker, tasks)
+        #Merge the root statistics of every tree.
+        visits = {}
+        wins = {}
+        self.playouts = 0
+        for result in results:
+            for column, (n, w) in result.items():
+                visits[column] = visits.get(column, 0) + n
+                wins[column] = wins.get(column, 0) + w
+                self.playouts += n
+        column = max(visits, key = visits.get)
+        return column, wins[column] / visits[column]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def grow_tree(self, board, player):
+        #One tree's search. Returns {column: (visits, wins)} for the root.
+        start = time.perf_counter()
+        root = mcts_node(None, None, 3 - player, board.legal_moves())
+        #A winning move needs no search, and would be all a tree finds anyway.
+        for column in root.untried:
+            if board.wins_at(column, player):
+                return {column: (1, 1.0)}
+        iterations = self.iterations
+        if iterations is None and self.time_limit is None:
+            iterations = self.default_iterations
+        count = 0
+        while True:
+            if iterations is not None and count >= iterations:
+                break
+            if self.time_limit is not None and count > 0 and \
+                time.perf_counter() - start >= self.time_limit:
+                break
+            if self.stop_event is not None and self.stop_event.is_set() \
+                and count > 0:
+                break
+            count += 1
+            node = root
+            depth = 0
+            #Select
+            while len(node.untried) == 0 and len(node.children) > 0:
+                node = node.uct_child(self.c)
+                board.make(node.column, node.player)
+                depth += 1
+            #Expand
+            if len(node.untried) > 0:
+                column = node.untried.pop(self.rng.randrange(len(node.untried)))
+                mover = 3 - node.player
+                won = board.wins_at(column, mover)
+                board.make(column, mover)
+                depth += 1
+                untried = []
+                if not won:
+                    untried = board.legal_moves()
+                child = mcts_node(node, column, mover, untried, won)
+                node.children.append(child)
+                node = child
+            #Simulate
+            if node.won:
+                winner = node.player
+            else:
+                winner = self.play_out(board, 3 - node.player)
+            #Backpropagate
+            while node is not None:
+                node.visits += 1
+                if winner == node.player:
+                    node.wins += 1
+                elif winner == 0:
+                    node.wins += 0.5
+                node = node.parent
+            for d in range(depth):
+                board.unmake()
+        result = {}
+        for child in root.children:
+            result[child.column] = (child.visits, child.wins)
+        return result
+
+    def play_out(self, board, player):
+        #Play to the end of the game, returns the winner (0 for a draw).
+        made = 0
+        winner = 0
+        while True:
+            moves = board.legal_moves()
+            if len(moves) == 0:
+                break
+            column = None
+            for move in moves:
+                if board.wins_at(move, player):
+                    column = move
+                    winner = player
+                    break
+            if column is None:
+                if self.rollout == 'flex':
+                    weights = [self.game.calc_flexibility( \
+                        (move, board.bottom_row(move)), player, board) \
+                        for move in moves]
+                    column = self.rng.choices(moves, weights)[0]
+                else:
+                    column = self.rng.choice(moves)
+            board.make(column, player)
+            made += 1
+            if winner != 0:
+                break
+            player = 3 - player
+        for d in range(made):
+            board.unmake()
+        return winner
+
+#Each mcts worker process keeps its own headless game for the playouts.
+worker_game = None
+
+def mcts_worker(task):
+    #Grow one tree in a worker process, task is from mcts_search.best_move.
+    global worker_game
+    board, player, iterations, time_limit, rollout, c, seed = task
+    if worker_game is None or worker_game.size_x != board.size_x or \
+        worker_game.size_y != board.size_y or worker_game.k != board.k:
+        worker_game = connect_four(None, 1, size_x = board.size_x, \
+            size_y = board.size_y, k = board.k)
+    tree = mcts_search(worker_game, iterations, time_limit, 1, rollout, c, seed)
+    return tree.grow_tree(board, player)
+
+class opening_book:
+    '''
+    Precomputed best moves for the first few plies, built by
+    Connect4_Book.py. The file is a sorted .npy array of uint64 entries,
+    each the position's Zobrist hash with its low 8 bits replaced by the
+    book move's column. A book only fits the board size and k it was
+    built for.
+
+    It's opened memory-mapped, so loading is instant and worker processes
+    all share the one page-cached copy. Lookups binary search it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = np.load(path, mmap_mode = 'r')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, board):
+        #Book column for the board's position, None if it's not in the book.
+        target = board.hash >> 8 << 8
+        index = np.searchsorted(self.entries, np.uint64(target))
+        if index < len(self.entries):
+            entry = int(self.entries[index])
+            if entry >> 8 == board.hash >> 8:
+                column = entry & 0xFF
+                if column < board.size_x and board.can_play(column):
+                    return column
+        return None
+
+class endgame_solver:
+    '''
+    Exact win/draw/loss solver for positions with at most max_empty open
+    cells, where the rest of the game tree is small enough to search to the
+    end (16 solves in well under a second on 7x6). Results are 1 (the player to move wins), 0 (draw) or -1 (loss).
+
+    It's an alpha-beta negamax on that 3 value window. A win is taken as
+    soon as one is seen, and if the opponent threatens to win the move
+    that blocks it is the only one searched (two threats is a loss).
+
+    Solved positions are kept in cache, an OrderedDict keyed by
+    bit_board.hash of (value, bound flag) like trans_table's entries. It
+    holds at most max_entries positions, dropping the oldest first. save
+    writes it to path as .npz and a new solver loads it back, if it's for
+    the same board size and k.
+    '''
+
+    def __init__(self, max_empty = 16, max_entries = 2**18, path = None, \
+        size = (7, 6, 4)):
+        self.max_empty = max_empty #0 to turn the solver off.
+        self.max_entries = max_entries
+        if path is not None and not path.endswith('.npz'):
+            path += '.npz' #np.savez adds it, so load from the file it writes.
+        self.path = path
+        self.size = size #(size_x, size_y, k) the cache is for.
+        self.cache = collections.OrderedDict()
+        self.nodes = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def can_solve(self, board):
+        empty = board.size_x * board.size_y - len(board.moves)
+        return empty <= self.max_empty
+
+    def best_move(self, board, player):
+        '''
+        Returns the column with the best result for player to move, and
+        that result. Ties go to the most central column.
+        '''
+        self.nodes = 0
+        center = (board.size_x - 1) / 2.0
+        moves = sorted(board.legal_moves(), key=lambda c: abs(c - center))
+        for column in moves:
+            if board.wins_at(column, player):
+                return column, 1
+        best = (moves[0], -2)
+        for column in moves:
+            board.make(column, player)
+            result = -self.solve(board, 3 - player, -1, -best[1])
+            board.unmake()
+            if result > best[1]:
+                best = (column, result)
+            if result == 1:
+                break
+        return best
+
+    def solve(self, board, player, alpha = -1, beta = 1):
+        #Result of board for player to move, the last move didn't win.
+        self.nodes += 1
+        moves = board.legal_moves()
+        if len(moves) == 0:
+            return 0 #Draw, board is full.
+        for column in moves:
+            if board.wins_at(column, player):
+                return 1
+        other = 3 - player
+        threats = [c for c in moves if board.wins_at(c, other)]
+        if len(threats) > 1:
+            return -1 #Can only block one of them.
+        if len(threats) == 1:
+            moves = threats
+        entry = self.cache.get(board.hash)
+        if entry is not None:
+            value, flag = entry
+            if flag == trans_table.exact:
+                return value
+            elif flag == trans_table.lower:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+        alpha_orig = alpha
+        center = (board.size_x - 1) / 2.0
+        moves.sort(key=lambda c: abs(c - center))
+        best = -1
+        for column in moves:
+            board.make(column, player)
+            score = -self.solve(board, other, -beta, -alpha)
+            board.unmake()
+            if score > best:
+                best = score
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+        if best <= alpha_orig:
+            flag = trans_table.upper
+        elif best >= beta:
+            flag = trans_table.lower
+        else:
+            flag = trans_table.exact
+        if len(self.cache) >= self.max_entries:
+            #popitem stays quick, deleting a dict's first key over and over
+            #leaves slots iter has to skip.
+            self.cache.popitem(last = False)
+        self.cache[board.hash] = (best, flag)
+        return best
+
+    def save(self, path = None):
+        #Write the cache to path (default the one it was loaded from).
+        if path is None:
+            path = self.path
+        keys = np.fromiter(self.cache.keys(), dtype = np.uint64, \
+            count = len(self.cache))
+        entries = np.array(list(self.cache.values()), dtype = np.int8)
+        np.savez(path, keys = keys, entries = entries.reshape(-1, 2), \
+            size = np.array(self.size))
+
+    def load(self, path):
+        data = np.load(path)
+        if tuple(data['size']) != tuple(self.size):
+            print("Solver cache", path, "is for another board, not loaded")
+            return
+        for key, (value, flag) in zip(data['keys'].tolist(), \
+            data['entries'].tolist()):
+            if len(self.cache) >= self.max_entries:
+                break
+            self.cache[key] = (value, flag)
 
 class connect_four:
 
-    def __init__(self, root, game_type):
+    def __init__(self, root, game_type, engine = 'max', book = None, \
+        size_x = 7, size_y = 6, k = 4):
         #game type is person v person or person v computer
+        #engine is 'max' for the 2 move lookahead, 'prob' to pick from the
+        #same scores at random (prob_move), 'search' for ai_search or 'mcts'
+        #for mcts_search.
+        #book is the path of an opening book file, if using one.
+        #Every engine hands over to the exact endgame_solver (self.solver)
+        #once the board is nearly full.
+        #root can be None to run without a window (no painting then).
+        #size_x by size_y is the board, k in a row wins.
         self.root = root
-        self.sq_size = 50
-        self.size_x = 7
-        self.size_y = 6
+        self.size_x = size_x
+        self.size_y = size_y
+        self.k = k
+        #Squares shrink to keep big boards on the screen.
+        self.sq_size = max(16, min(50, 700 // size_x, 600 // size_y))
         self.player = 1 #Keeps track of current player
         self.player_val = 0 #Keeps track of which player is the human.
-        self.frame = tk.Frame(root)
+        self.frame = None
+        if root is not None:
+            self.frame = tk.Frame(root)
         self.win_x = self.size_x * self.sq_size
         self.win_y = self.size_y * self.sq_size
         self.game_type = game_type
-        self.grid = np.zeros((self.size_x, self.size_y), dtype = int)
-        self.k = 0 #Used for keeping track of the current or previous move
-        self.l = 0
-        self.m = 0 #Used for keeping track of a simulated move
-        self.n = 0
+        self.board = bit_board(self.size_x, self.size_y, self.k)
         self.done = False #Used for testing if game ends.
+        self.engine = engine
+        self.search = ai_search(self)
+        self.mcts = mcts_search(self)
+        self.solver = endgame_solver(size = (size_x, size_y, k))
+        self.book = None
+        if book is not None:
+            self.book = opening_book(book)
+        self.c = None #Canvas, made in setup_canvas.
+        #Each grid location's rectangle is made once, then only recolored.
+        self.squares = {} #(i, j): canvas item id.
+        self.square_colors = {} #(i, j): the color it has now.
+        self.status = None #Label for the thinking indicator.
+        self.rng = np.random #Anything with a choice method, to seed prob_move.
+        self.score_table = None #Lookup tables for flex_scores, made on first use.
+        #The AI thinks on a background thread when there's a window.
+        self.worker = None #The thread, while it's running.
+        self.worker_id = 0 #think_id the thread is working on.
+        self.think_id = 0 #Bumped for every AI move asked for (or cancelled).
+        self.thinking = False
+        self.polling = False
+        self.poll_ms = 50
+        self.think_start = 0
+        self.stop_event = threading.Event()
+        self.results = queue.Queue() #(think_id, position)s from the thread.
         
     def setup_canvas(self):
         """
@@ -41,34 +977,53 @@ class connect_four:
                    text="Undo Last Move", 
                    fg="red",
                    command=self.undo)
+        button4 = tk.Button(self.root, 
+                   text="Redo Move", 
+                   fg="red",
+                   command=self.redo)
         button.pack()#side = "top")
         button2.pack()#side = "top")
         button3.pack()#side = "top")
+        button4.pack()#side = "top")
+        self.status = tk.Label(self.root, text="")
+        self.status.pack()
         self.c = tk.Canvas(self.root, width=self.win_x, height=self.win_y)
         self.c.focus_set()
         self.c.bind('<Key>', self.keypress)
+        self.c.bind('<Button-1>', self.click)
         self.c.pack(side = 'bottom')    
         
     def paint_square(self, i, j):
         """
-        Makes a square colored depending on the location input. 
+        Makes a square colored depending on the location input. The first
+        paint makes the rectangle, after that it's only recolored (and only
+        if the color changed), so the canvas never grows.
         """
+        if self.c is None:
+            return #Running without a window.
         color = 'black'
-        if self.grid[i][j] == 0:
+        cell = self.board.cell(i, j)
+        if cell == 0:
             color = 'snow'
-        elif self.grid[i][j] == 1:
+        elif cell == 1:
             color = 'red'
-        elif self.grid[i][j] == 2:
+        elif cell == 2:
             color = 'blue'
         else: 
             print('Grid location not open, red, or blue?')
-        if i > 6:
+        if i >= self.size_x:
             print(i, j)
             print(color)
         #Apply that color value to a rectangle at the proper location
-        s = self.sq_size
-        bounds = [s*i, s*j, s*(i+1), s*(j+1)]
-        self.c.create_rectangle(*bounds, fill=color, outline='#101010')
+        item = self.squares.get((i, j))
+        if item is None:
+            s = self.sq_size
+            bounds = [s*i, s*j, s*(i+1), s*(j+1)]
+            self.squares[(i, j)] = self.c.create_rectangle(*bounds, \
+                fill=color, outline='#101010')
+        elif self.square_colors[(i, j)] != color:
+            self.c.itemconfig(item, fill=color)
+        self.square_colors[(i, j)] = color
 
     #################
     ### INTERFACE ###
@@ -92,32 +1047,47 @@ class connect_four:
             else:
                 print("You must first choose your player by typing A or B.")
 
-        #If entering column for chip.
-        if i.isdigit() and not self.done:
-            i = int(i)
-            i = i - 1 #Assuming humans are not indexing from 0. 
-            if i not in range(7):
-                print("Columns are only 1 - 7")
-            elif self.player == self.player_val and i in range(7): 
-                j = self.find_bottom_row(self.grid, i)
-                if j < 0:
-                    print("That column is already full")
-                else:
-                    self.k = i
-                    self.l = j
-                    self.grid[i][j] = self.player
-                    self.paint_square(self.k, self.l)
-                    pos = (i, j)
-                    player_flex = self.calc_flexibility(pos, \
-                        self.player, self.grid)
-                    if player_flex >= 600:
-                        self.done = True
-                        print("The humans have done it! \
-                            We've beaten those durn machines!")
-                    else:
-                        self.player_swap()
-                        if self.player != self.player_val:
-                            self.calc_move()
+        #If entering column for chip - 1 - 9 then letters on wide boards.
+        elif i != "" and not self.done:
+            #Assuming humans are not indexing from 0.
+            i = self.board.move_chars.find(i.lower())
+            if i not in range(self.size_x):
+                print("Columns are only", self.column_keys())
+            else:
+                self.human_move(i)
+
+    def click(self, event):
+        #Clicking anywhere in a column drops a chip there.
+        if self.player_val == 0:
+            print("You must first choose your player by typing A or B.")
+        elif not self.done:
+            i = event.x // self.sq_size
+            if i in range(self.size_x):
+                self.human_move(i)
+
+    def human_move(self, i):
+        #Play the human's chip in column i, then let the AI reply.
+        if self.player != self.player_val:
+            return
+        j = self.find_bottom_row(self.board, i)
+        if j < 0:
+            print("That column is already full")
+        else:
+            self.board.play(i, self.player)
+            self.paint_square(i, j)
+            if self.board.is_win(self.player):
+                self.done = True
+                print("The humans have done it! \
+                    We've beaten those durn machines!")
+                print("Moves:", self.board.to_moves())
+            else:
+                self.player_swap()
+                if self.player != self.player_val:
+                    self.calc_move()
+
+    def column_keys(self):
+        #The keys for the first and last columns, eg "1 - 7".
+        return "1 - " + self.board.move_chars[self.size_x - 1]
 
 
     ###################
@@ -133,57 +1103,177 @@ class connect_four:
             return False
 
     def calc_move(self):
+        '''
+        Pick the AI's move with the chosen engine and play it. With a window
+        the engine runs on a background thread so the window never freezes,
+        and poll_move plays the move on the Tk loop once it's ready.
+        '''
+        if self.root is None:
+            self.play_ai_move(self.pick_move())
+            return
+        self.think_id += 1
+        self.thinking = True
+        self.think_start = time.time()
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.poll_ms, self.poll_move)
+
+    def think(self, board, player, think_id):
+        #Background thread - works on its own copy of the board.
+        position = self.pick_move(board, player)
+        self.results.put((think_id, position))
+
+    def poll_move(self):
+        #Runs every poll_ms on the Tk loop while the AI is thinking.
+        if self.worker is not None and not self.worker.is_alive():
+            self.worker = None
+        while not self.results.empty():
+            think_id, position = self.results.get()
+            if think_id == self.think_id and self.thinking:
+                self.thinking = False
+                self.status.config(text="")
+                self.play_ai_move(position)
+        #Only one search runs at a time, a cancelled one stops within a few
+        #nodes (or its time budget for mcts pools) before the next starts.
+        if self.thinking and self.worker is None:
+            self.stop_event = threading.Event()
+            self.search.stop_event = self.stop_event
+            self.mcts.stop_event = self.stop_event
+            self.worker_id = self.think_id
+            self.worker = threading.Thread(target=self.think, \
+                args=(self.board.copy(), self.player, self.think_id))
+            self.worker.daemon = True
+            self.worker.start()
+        if self.thinking:
+            secs = time.time() - self.think_start
+            dots = "." * (int(secs * 4) % 4)
+            self.status.config(text="Thinking" + dots.ljust(3) + \
+                " " + str(round(secs, 1)) + "s")
+        if self.thinking or self.worker is not None:
+            self.root.after(self.poll_ms, self.poll_move)
+        else:
+            self.polling = False
+
+    def cancel_thinking(self):
+        #Drop the AI move being worked on, eg for a Reset or Undo.
+        if self.thinking:
+            self.think_id += 1
+            self.thinking = False
+            self.stop_event.set()
+            if self.status is not None:
+                self.status.config(text="")
+
+    def play_ai_move(self, position):
+        if position is None:
+            return #Board is full.
+        i, j = position
+        self.board.play(i, self.player)
+        self.paint_square(i, j)
+        if self.board.is_win(self.player):
+            print("Computer player wins!")
+            print("Moves:", self.board.to_moves())
+            self.done = True
+        self.player_swap()
+
+    def set_budget(self, time_limit = None, node_limit = None, \
+        iterations = None):
+        '''
+        Search budget per move: time_limit seconds and/or node_limit nodes
+        for ai_search, and the same time and iterations (default node_limit)
+        for mcts_search. None is no limit, except mcts with neither stops
+        at mcts_search.default_iterations. mcts keeps its one process, so a
+        game in a pool worker (which can't have a pool of its own) is fine.
+        '''
+        if iterations is None:
+            iterations = node_limit
+        self.search.time_limit = time_limit
+        self.search.node_limit = node_limit
+        self.mcts.time_limit = time_limit
+        self.mcts.iterations = iterations
+
+    def pick_move(self, board = None, player = None):
+        '''
+        Returns the grid location the engine would play for player on board
+        (the game's own by default), None if no moves.
+        '''
+        if board is None:
+            board = self.board
+        if player is None:
+            player = self.player
+        if len(board.legal_moves()) == 0:
+            return None
+        if self.book is not None:
+            column = self.book.lookup(board)
+            if column is not None:
+                return (column, board.bottom_row(column))
+        if self.solver.can_solve(board):
+            column, result = self.solver.best_move(board, player)
+            return (column, board.bottom_row(column))
+        if self.engine == 'search':
+            column, score = self.search.best_move(board, player)
+            return (column, board.bottom_row(column))
+        if self.engine == 'mcts':
+            column, score = self.mcts.best_move(board, player)
+            return (column, board.bottom_row(column))
+        return self.two_ply_move(board, player)
+
+    def two_ply_move(self, board, player):
+        #Look at each of our moves, then the opponent's best reply to it.
+        win, moves = self.two_ply_scores(board, player)
+        if win is not None:
+            return win
+        if self.engine == 'prob':
+            return self.prob_move(moves) #PROBABALISTIC VERSION (Not very good atm)
+        move = max(moves, key=lambda item:item[1])[0] #DETERMINISTIC VERSION (Ok, but boring atm)
+        return move
+
+    def two_ply_scores(self, board, player):
+        '''
+        Score each of player's moves by its flexibility minus twice the
+        opponent's best reply. Returns a winning position (or None if there
+        isn't one) and the list of (position, score) tuples.
+        '''
         moves = []
-        opens = self.find_opens(self.grid)
-
-        for position in opens:           
-            i, j = position
-            grid_pointer = self.grid
-            temp_grid = grid_pointer.copy()
-            temp_grid[i][j] = self.player
-            flex = self.calc_flexibility(position, self.player, temp_grid)    
-
-            if flex >= 600: 
-                #Do move b.c. this means the move wins.
-                self.grid[i][j] = self.player
-                self.paint_square(i, j)
-                print("Computer player wins!")
-                self.player_swap()
-                self.m = i
-                self.n = j
-                self.done = True
-                break
-            
-            else:
-                opponent_flexs = []
-                opens2 = self.find_opens(temp_grid)     
-                for position2 in opens2:
-                    i1, j1 = position2
-                    temp_grid2 = temp_grid.copy()
-                    temp_grid2[i1][j1] = self.other_player()
-                    opp_flex = self.calc_flexibility(position2, \
-                        self.other_player(), temp_grid2)
-                    opponent_flexs.append(opp_flex)
-                #The case where the entire board is almost filled up.
-                if len(opponent_flexs) != 0:
-                    neg_flex = max(opponent_flexs)
-                else:
-                    neg_flex = 0
-
-                neg_flex = -2 * neg_flex
-                total_flex = neg_flex + flex
-                tup = (position, total_flex)
-                moves.append(tup)
-
-        if len(moves) != 0 and (not self.done): #If = 0 then calc move should have found a winning move.
-            move = max(moves, key=lambda item:item[1])[0] #DETERMINISTIC VERSION (Ok, but boring atm)
-            #move = self.prob_move(moves) #PROBABALISTIC VERSION (Not very good atm)
-            i, j = move
-            self.m = i
-            self.n = j
-            self.grid[i][j] = self.player
-            self.paint_square(i, j)
-            self.player_swap()
+        opens = self.find_opens(board)
+
+        for position in opens:
+            #Do move b.c. this means the move wins.
+            if board.wins_at(position[0], player):
+                return position, moves
+
+        #Every reply to every move is scored at once - one board per move.
+        n = len(opens)
+        cols = np.array([pos[0] for pos in opens])
+        rows = np.array([pos[1] for pos in opens])
+        grids = np.repeat(board.to_array()[np.newaxis], n, axis = 0)
+        grids[np.arange(n), cols, rows] = player
+
+        #Where each column's next chip goes on each of those boards.
+        reply_rows = np.full((n, self.size_x), -1)
+        for pos in opens:
+            reply_rows[:, pos[0]] = pos[1]
+        reply_rows[np.arange(n), cols] = rows - 1
+        #Only the move and the replies get scored, not the whole board, so
+        #this grows with the width and not with the number of cells.
+        #(A full column's reply goes to the off-board cell.)
+        cells = np.empty((n, self.size_x + 1), dtype = np.intp)
+        cells[:, 0] = cols * self.size_y + rows
+        cells[:, 1:] = np.where(reply_rows >= 0, \
+            np.arange(self.size_x) * self.size_y + reply_rows, \
+            self.size_x * self.size_y)
+        scores = self.flex_scores(grids, cells)
+        flex = scores[:, player - 1, 0]
+        #The case where the entire board is almost filled up - a full
+        #column has no reply, and no replies at all counts as 0.
+        opp_flex = np.where(reply_rows >= 0, scores[:, 2 - player, 1:], 0)
+        neg_flex = -2 * opp_flex.max(axis = 1)
+        total_flex = neg_flex + flex
+
+        for k in range(n):
+            tup = (opens[k], float(total_flex[k]))
+            moves.append(tup)
+
+        return None, moves
                   
     def prob_move(self, moves):
         '''
@@ -199,16 +1289,16 @@ class connect_four:
             #random choice can't accept a list of tuples, so use indexs.
             indexs = range(0, len(moves))
             for move in moves:
-                flex = round(move[1], 1)
+                #Cap near 0 scores, 1/0 was where the nan issues came from.
+                flex = min(round(move[1], 1), -0.1)
                 flex = 1.0/flex
-                f2 = round(flex**3, 12) #Skew the distribution more. 
-                f2 = abs(f2)
+                #Skew the distribution more. No rounding, it made big 
+                #negatives 0 and then the sum could be 0 too.
+                f2 = abs(flex**3)
                 pscores.append(f2)
-            print("Negs case SUM", sum(pscores))
-            summ = sum(pscores) #Trying to figure out why nan issues
+            summ = sum(pscores)
             pscores = np.array(pscores)/summ
-            print("Negs case", pscores)
-            choice_index = np.random.choice(indexs, p = pscores)
+            choice_index = self.rng.choice(indexs, p = pscores)
             move = moves[choice_index]
             move = move[0]
             return move
@@ -224,12 +1314,11 @@ class connect_four:
                     positives.append(move)
             indexs = range(0, len(positives))
             for pos_move in positives:
-                flex = move[1]
+                flex = pos_move[1]
                 f2 = round(flex**2, 2)
                 pscores.append(f2)
             pscores = np.array(pscores)/sum(pscores)
-            print("One+ Pos", pscores)
-            choice_index = np.random.choice(indexs, p = pscores)
+            choice_index = self.rng.choice(indexs, p = pscores)
             move = positives[choice_index]
             move = move[0]
             return move
@@ -244,37 +1333,32 @@ class connect_four:
             print("Somehow player is not 1 or 2 when using Other Player func")
 
     def to_score(self, count):
-        #Converts a number in a row to a flexibility score.
-        if count < 1:
-            return 2
-        elif count == 1:
-            return 8
-        elif count == 2:
-            return 32
-        #Have 4 in a row vastly overweight.
-        elif count >= 3:
+        #Converts a number in a row to a flexibility score - 2, 8, 32...
+        #Have k in a row vastly overweight.
+        if count >= self.k - 1:
             return 1000
+        return 2 * 4**max(count, 0)
+
+    row_mults = (1, 1.5, 3, 1.5, 0.5, 0.5) #By row on a 6 high board, top first.
 
     def pos_score_mod(self, score, pos):
-        #More flexible if position is near the center - use mults for this.
+        '''
+        More flexible if position is near the center - use mults for this.
+        The center column gets 4, halving per column out down to .5 three
+        columns away (wider boards stretch that over their half width).
+        Rows are weighted like the 6 rows of the standard board, stretched
+        to the board's height.
+        '''
         i, j = pos
-        if i == 3:
-            mult1 = 4
-        elif i == 2 or i == 4:
-            mult1 = 2
-        elif i == 1 or i == 5:
-            mult1 = 1
-        else:
-            mult1 = .5
-
-        if j == 2:
-            mult2 = 3
-        elif j == 1 or j == 3:
-            mult2 = 1.5
-        elif j == 0:
-            mult2 = 1
-        else:
-            mult2 = 0.5
+        center = (self.size_x - 1) / 2.0
+        dist = abs(i - center)
+        if center > 3:
+            dist = dist * 3 / center
+        mult1 = max(0.5, 4 * 0.5**dist)
+
+        if self.size_y > 1:
+            j = int(round(j * 5.0 / (self.size_y - 1)))
+        mult2 = self.row_mults[j]
 
         return score * mult1 * mult2
 
@@ -291,88 +1375,99 @@ class connect_four:
         pos - tuple contain the grid cordinates you want to place
         cur_player - the value of the player (yours or opponent/ 1, 2) 
             whos move you'll be calculating
-        board - the board you'll be calculating on - an array.
+        board - the bit_board you'll be calculating on.
 
         returns a float which represents the flexibility of the input move.
         '''
 
-        i = pos[0]
-        j = pos[1]
-        vert_mat = range(6)
-        hori_mat = range(7)
         flex = 0
-        #Verticle
-        vert_count = 0
-        for h in range(1,4):
-            if (j + h) in vert_mat: #Plus signs b.c. my matrix fills from the top down
-                if cur_player == board[i][j + h]:
-                    vert_count += 1
-                else:
-                    break
-        #print("Vert Count: ", vert_count)
-        flex += self.to_score(vert_count)
-
-        #Horizontal
-        hori_count = 0
-        #Need two separate for loops so you don't break counting backwards 
-        #if you run into a dif color going forwards.
-        for h in range(1,7):
-            if (i + h) in hori_mat:
-                if cur_player == board[i + h][j]:
-                    hori_count += 1
-                else:
-                    break
-        for h in range(1,7):
-            if (i - h) in hori_mat:
-                if cur_player == board[i - h][j]:
-                    hori_count += 1
-                else:
-                    break
-        #print("Hori Count: ", hori_count)
-        flex += self.to_score(hori_count)
-
-        #Diagonal1
-        diag1_count = 0
-        for h in range(1,6):
-            if ((i + h) in hori_mat) and ((j + h) in vert_mat):
-                if cur_player == board[i + h][j + h]:
-                    diag1_count += 1
-                else:
-                    break
-
-        for h in range(1,6):
-            if ((i - h) in hori_mat) and ((j - h) in vert_mat):
-                if cur_player == board[i - h][j - h]:
-                    diag1_count += 1
-                else:
-                    break                    
-
-        #print("Diag1 Count: ", diag1_count)
-        flex += self.to_score(diag1_count)
+        for count in board.run_counts(pos, cur_player):
+            flex += self.to_score(count)
+        flex = self.pos_score_mod(flex, pos)
+        return flex
 
-        #Diagonal2
-        diag2_count = 0
-        for h in range(1,6):
-            if ((i + h) in hori_mat) and ((j - h) in vert_mat):
-                if cur_player == board[i + h][j - h]:
-                    diag2_count += 1
-                else:
-                    break
+    def flex_scores(self, grids, cells = None):
+        '''
+        calc_flexibility for every cell of a batch of boards, for both
+        players, in one pass of NumPy operations instead of a call per cell.
 
-        for h in range(1,6):
-            if ((i - h) in hori_mat) and ((j + h) in vert_mat):
-                if cur_player == board[i - h][j + h]:
-                    diag2_count += 1
-                else:
-                    break                    
+        grids - (n, size_x, size_y) array of boards (0 open, 1 or 2).
+        cells - optional (n, t) array of flat cell indices (i * size_y + j)
+            to score on each board, size_x * size_y for an off-board cell.
 
-        #print("Diag2 Count: ", diag2_count)
-        flex += self.to_score(diag2_count)
+        Returns a (n, 2, size_x, size_y) float array, [:, player - 1] holding
+        that player's flexibility at each cell, same as calc_flexibility -
+        or (n, 2, t) for just the given cells (off-board ones score 0).
+        (Filled cells get a score too, it's just meaningless.)
+        '''
+        if self.score_table is None:
+            self.make_flex_tables()
+        n = len(grids)
+        size = self.size_x * self.size_y
+        #One extra always open cell at the end, off-board neighbours use it.
+        flat = np.zeros((n, size + 1), dtype = grids.dtype)
+        flat[:, :size] = grids.reshape(n, size)
+        #neighbours[p, board, direction, step, cell] - is it player p's chip.
+        if cells is None:
+            neighbours = flat[:, self.line_index[:, :, :size]]
+            pos_table = self.pos_table[:size]
+        else:
+            index = np.moveaxis(self.line_index[:, :, cells], 2, 0)
+            neighbours = flat[np.arange(n).reshape(n, 1, 1, 1), index]
+            pos_table = self.pos_table[cells]
+        neighbours = neighbours[np.newaxis] == np.array([1, 2]).reshape(2, 1, 1, 1, 1)
+        run = neighbours[:, :, :, 0]
+        runs = run.astype(np.int8)
+        for h in range(1, neighbours.shape[3]):
+            run = run & neighbours[:, :, :, h]
+            runs += run
+        #Vertical only counts below, the other lines count both ways.
+        counts = runs[:, :, [0, 1, 3, 5]]
+        counts[:, :, 1:] += runs[:, :, [2, 4, 6]]
+        flex = self.score_table[counts].sum(axis = 2) * pos_table
+        if cells is not None:
+            return flex.transpose(1, 0, 2)
+        return flex.reshape(2, n, self.size_x, self.size_y).transpose(1, 0, 2, 3)
 
-        flex = self.pos_score_mod(flex, pos)
+    def make_flex_tables(self):
+        '''
+        Precompute the tables flex_scores uses: to_score for every count a
+        line can have, the pos_score_mod weight of every cell, and for every
+        cell the flat index of its neighbours along each half line. The
+        off-board cell X * Y is on the end of both, scoring 0.
+        '''
+        L = self.k - 1 #Runs longer than this score the same, so don't look further.
+        X = self.size_x
+        Y = self.size_y
+        self.score_table = np.array([self.to_score(c) for c in range(2*L + 1)])
+        self.pos_table = np.array([self.pos_score_mod(1, (i, j)) \
+            for i in range(X) for j in range(Y)] + [0])
+        #Down, then both ways along horizontal, diagonal1 and diagonal2.
+        half_lines = [(0, 1), (1, 0), (-1, 0), (1, 1), (-1, -1), (1, -1), (-1, 1)]
+        i = np.repeat(np.arange(X), Y)
+        j = np.tile(np.arange(Y), X)
+        self.line_index = np.full((len(half_lines), L, X * Y + 1), X * Y)
+        for d, (di, dj) in enumerate(half_lines):
+            for h in range(1, L + 1):
+                i1 = i + h * di
+                j1 = j + h * dj
+                inside = (i1 >= 0) & (i1 < X) & (j1 >= 0) & (j1 < Y)
+                self.line_index[d, h - 1, :X * Y] = np.where(inside, \
+                    i1 * Y + j1, X * Y)
 
-        #print(flex)
-        return flex
+    def evaluate(self, board, player):
+        '''
+        Static score of board for player (who is about to move), used at
+        the leaves of ai_search: player's most flexible open spot minus the
+        opponent's most flexible open spot.
+        '''
+        other = 3 - player
+        own = 0
+        opp = 0
+        for pos in self.find_opens(board):
+            own = max(own, self.calc_flexibility(pos, player, board))
+            opp = max(opp, self.calc_flexibility(pos, other, board))
+        return own - opp
 
     def player_swap(self):
         if self.player == 1:
@@ -382,61 +1477,115 @@ class connect_four:
         else:
             print("Somehow player is not 1 or 2?")
 
-    def find_bottom_row(self, grid, column):
+    def find_bottom_row(self, board, column):
         #For a given column, find the min row thats empty.
-        max_j = -1
-        for j in range(self.size_y):
-            if grid[column][j] == 0:
-                if j > max_j:
-                    max_j = j
-        return max_j
-
-    def find_opens(self, grid):
+        return board.bottom_row(column)
+
+    def find_opens(self, board):
         #Return a list of bottom spots that are open.
-        opens = []
-        for i in range(self.size_x):
-            max_j = self.find_bottom_row(grid, i)
-            if max_j != -1:
-                loc = (i, max_j)
-                opens.append(loc)
-        return opens
+        return board.opens()
 
     def color_grid(self):
-        #Go through each loc & color it.
+        #Go through each loc & color it - only changed ones get redrawn.
         for i in range(self.size_x):
             for j in range(self.size_y):
                 self.paint_square(i, j)
 
     def reset(self):
         #Resets the board to all white. 
-        self.grid = np.zeros((self.size_x, self.size_y), dtype = int)
+        self.cancel_thinking()
+        self.board = bit_board(self.size_x, self.size_y, self.k)
+        self.search.new_game()
         self.color_grid()
         self.player = 1
         self.player_val = 0
         self.done = False
         print("If you would like to play first, enter A. If you would like to play second, enter B.")
         print()
-        print("Use number keys 1 - 7 to enter the row you would like to deposit your chip on.")   
+        print("Use keys", self.column_keys(), "(or click) to enter the row you would like to deposit your chip on.")   
 
     def undo(self):
+        '''
+        Take back moves until it's the human's turn again - their last move
+        and the AI's reply. Can be pressed repeatedly, back to the start.
+        '''
+        #The AI's opening move stays if the human went second. Checked
+        #before cancelling, so the AI keeps thinking if nothing changes.
+        if self.player_val == 0 or len(self.board.moves) < self.player_val:
+            print("No moves to undo")
+            return
+        self.cancel_thinking()
+        i = self.board.undo()
+        self.paint_square(i, self.board.bottom_row(i))
+        while self.board.next_player() != self.player_val:
+            i = self.board.undo()
+            self.paint_square(i, self.board.bottom_row(i))
+        self.player = self.player_val
         self.done = False
-        #Check if win - if won, need to scrap message? 
-        if self.grid[self.k][self.l] != 0: #Need to ensure the right player is kept if pressed multiple times.
-            self.grid[self.k][self.l] = 0
-            self.grid[self.m][self.n] = 0
-            self.paint_square(self.k, self.l)
-            self.paint_square(self.m, self.n)
+
+    def redo(self):
+        #Replay undone moves up to the human's turn (or the end of the game).
+        if len(self.board.redo_moves) == 0:
+            print("No moves to redo")
+            return
+        self.cancel_thinking()
+        while len(self.board.redo_moves) > 0 and not self.done:
+            player = self.board.redo_moves[-1][1]
+            i, j = self.board.redo()
+            self.paint_square(i, j)
+            if self.board.is_win(player):
+                self.done = True
+            if self.board.next_player() == self.player_val:
+                break
+        self.player = self.board.next_player()
+        if self.done:
+            print("Game over, moves:", self.board.to_moves())
+        elif self.player != self.player_val:
+            self.calc_move() #Nothing left to redo, the AI moves again.
+
+    def replay(self, moves):
+        #Set the board up from a move string, eg one a finished game printed.
+        self.board = bit_board.from_moves(moves, self.size_x, self.size_y, \
+            self.k)
+        self.player = self.board.next_player()
+        self.done = self.board.is_win(1) or self.board.is_win(2)
+        self.color_grid()
 
     def test_game(self):
         #Setup & run game.
         self.setup_canvas()
         self.color_grid()
 
-print("If you would like to play first, enter A. If you would like to play second, enter B.")
-print()
-print("Use number keys 1 - 7 to enter the row you would like to deposit your chip on.")                
-root = tk.Tk()
-Sim = connect_four(root, 1)
-Sim.test_game()
-tk.mainloop()
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Play Connect 4 (or K).")
+    parser.add_argument("--width", type = int, default = 7)
+    parser.add_argument("--height", type = int, default = 6)
+    parser.add_argument("--k", type = int, default = 4, help = "k in a row wins")
+    parser.add_argument("--engine", default = 'search', \
+        choices = ['max', 'prob', 'search', 'mcts'])
+    parser.add_argument("--solver-cache", default = None, \
+        help = "endgame solver cache file (.npz) to load and save on exit")
+    args = parser.parse_args()
+    print("If you would like to play first, enter A. If you would like to play second, enter B.")
+    print()
+    root = tk.Tk()
+    book = None
+    #The book is for the standard board only.
+    if os.path.exists('connect4_book.npy') and \
+        (args.width, args.height, args.k) == (7, 6, 4):
+        book = 'connect4_book.npy'
+    Sim = connect_four(root, 1, engine = args.engine, book = book, \
+        size_x = args.width, size_y = args.height, k = args.k)
+    if args.solver_cache is not None:
+        Sim.solver = endgame_solver(path = args.solver_cache, \
+            size = (args.width, args.height, args.k))
+    print("Use keys", Sim.column_keys(), "(or click) to enter the row you would like to deposit your chip on.")                
+    Sim.test_game()
+    try:
+        tk.mainloop()
+    finally:
+        #Quit raises SystemExit out of mainloop, so save here either way.
+        if args.solver_cache is not None:
+            Sim.solver.save()
             
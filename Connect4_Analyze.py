@@ -0,0 +1,170 @@
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import sys
+import time
+from Connect4 import ai_search, bit_board, connect_four
+
+'''
+Scores recorded positions with the connect_four engines, for archives too
+big to load at once.
+
+Positions are read as move strings (see bit_board.to_moves), one per line,
+from a file or stdin, in chunks that are analyzed across a process pool.
+Only a fixed window of chunks is in flight at once and results are
+written out in input order as soon as they're back, so memory use is the
+same for a hundred positions or a hundred million. (Pool.imap would read
+the whole input into its task queue up front.)
+
+Each result is the position, the side to move, the best move (in the
+move string's column notation) and its score from the mover's side - the
+2-ply flexibility score for 'max', the search score for 'search' (wins
+are near ai_search.win_score) or the win rate for 'mcts'. Positions that
+are already over have no best move, and bad move strings get an error.
+
+Example - best moves for every position in a file, 10000 search nodes each:
+    python Connect4_Analyze.py games.txt --engine search --nodes 10000 \
+        --out analysis.jsonl
+    cat games.txt | python Connect4_Analyze.py - > analysis.jsonl
+'''
+
+engines = ['max', 'search', 'mcts']
+
+fields = ['moves', 'player', 'best', 'score', 'error']
+
+#Each worker process keeps its own headless game for the analysis.
+worker_game = None
+
+def init_worker(engine, time_limit, node_limit, size = (7, 6, 4)):
+    global worker_game
+    size_x, size_y, k = size
+    worker_game = connect_four(None, 1, engine = engine, size_x = size_x, \
+        size_y = size_y, k = k)
+    worker_game.set_budget(time_limit, node_limit)
+
+def analyze(moves):
+    #Result row for one move string.
+    game = worker_game
+    row = {'moves': moves, 'player': None, 'best': None, 'score': None, \
+        'error': None}
+    try:
+        board = bit_board.from_moves(moves, game.size_x, game.size_y, game.k)
+    except ValueError as e:
+        row['error'] = str(e)
+        return row
+    player = board.next_player()
+    row['player'] = player
+    if board.is_win(1) or board.is_win(2) or board.is_full():
+        return row #Game over, nothing to pick.
+    if game.engine == 'search':
+        column, score = game.search.best_move(board, player)
+    elif game.engine == 'mcts':
+        column, score = game.mcts.best_move(board, player)
+    else:
+        win, moves = game.two_ply_scores(board, player)
+        if win is not None:
+            column, score = win[0], ai_search.win_score
+        else:
+            position, score = max(moves, key = lambda item: item[1])
+            column = position[0]
+    row['best'] = board.move_chars[column]
+    row['score'] = round(float(score), 4)
+    return row
+
+def analyze_chunk(chunk):
+    return [analyze(moves) for moves in chunk]
+
+def read_chunks(lines, size):
+    #Move strings in lists of size, skipping blank lines and # comments.
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        chunk.append(line.split()[0])
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def analyze_stream(lines, out, engine = 'max', time_limit = None, \
+    node_limit = 10000, workers = None, chunk_size = 64, window = None, \
+    size = (7, 6, 4), jsonl = True):
+    '''
+    Analyze every move string in the iterable lines over workers processes
+    (None for one per core), writing result rows to the open file out in
+    order. At most window chunks (default twice the workers) of chunk_size
+    positions are in flight at once. Returns the number of positions.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if window is None:
+        window = 2 * workers
+    pool = multiprocessing.Pool(workers, init_worker, \
+        (engine, time_limit, node_limit, size))
+    writer = None
+    if not jsonl:
+        writer = csv.DictWriter(out, fieldnames = fields)
+        writer.writeheader()
+    pending = collections.deque()
+    count = 0
+
+    def write(result):
+        for row in result.get():
+            if jsonl:
+                out.write(json.dumps(row) + '\n')
+            else:
+                writer.writerow(row)
+        out.flush()
+        return len(result.get())
+
+    for chunk in read_chunks(lines, chunk_size):
+        pending.append(pool.apply_async(analyze_chunk, (chunk,)))
+        if len(pending) >= window:
+            count += write(pending.popleft())
+    while len(pending) > 0:
+        count += write(pending.popleft())
+    pool.close()
+    pool.join()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = \
+        "Find the best move in each of a stream of connect_four positions.")
+    parser.add_argument("path", help = "file of move strings, - for stdin")
+    parser.add_argument("--engine", default = 'max', choices = engines)
+    parser.add_argument("--out", default = None, \
+        help = "results file, .csv or .jsonl (default jsonl to stdout)")
+    parser.add_argument("--time", type = float, default = None, \
+        help = "search/mcts seconds per position")
+    parser.add_argument("--nodes", type = int, default = 10000, \
+        help = "search nodes (or mcts iterations) per position")
+    parser.add_argument("--workers", type = int, default = None, \
+        help = "worker processes, default one per core")
+    parser.add_argument("--chunk", type = int, default = 64, \
+        help = "positions sent to a worker at a time")
+    parser.add_argument("--window", type = int, default = None, \
+        help = "chunks in flight at once, default twice the workers")
+    parser.add_argument("--width", type = int, default = 7)
+    parser.add_argument("--height", type = int, default = 6)
+    parser.add_argument("--k", type = int, default = 4, help = "k in a row wins")
+    args = parser.parse_args()
+    start = time.time()
+    lines = sys.stdin
+    if args.path != '-':
+        lines = open(args.path)
+    out = sys.stdout
+    if args.out is not None:
+        out = open(args.out, 'w', newline = '')
+    jsonl = args.out is None or not args.out.endswith('.csv')
+    count = analyze_stream(lines, out, args.engine, args.time, args.nodes, \
+        args.workers, args.chunk, args.window, \
+        (args.width, args.height, args.k), jsonl)
+    if out is not sys.stdout:
+        out.close()
+    print("Analyzed", count, "positions in", round(time.time() - start, 1), \
+        "s", file = sys.stderr)
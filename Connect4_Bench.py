@@ -0,0 +1,232 @@
+import argparse
+import json
+import platform
+import resource
+import time
+import tracemalloc
+import numpy as np
+from Connect4 import bit_board, connect_four, endgame_solver
+
+'''
+Headless benchmarks for the connect_four AI, to check performance changes
+against a baseline.
+
+Every engine picks a move in each position of a fixed corpus (opening,
+middlegame and endgame, as move strings) - the same work calc_move does,
+without a window. Searches run on node/iteration budgets rather than the
+clock so every run does the same work. Per engine and phase it reports
+move latency percentiles, search nodes (or mcts playouts) per second, and
+memory per move from a separate tracemalloc pass, as timing with tracing on
+is meaningless. Python has no count of allocations, so allocation per move
+is given in bytes: peak_kb, the most a move has allocated at once, and
+kept_kb, what it still holds after. The engines have the endgame solver turned off so
+they're timed on their own, and the solver, calc_flexibility and evaluate
+get their own timings.
+
+Results are written as JSON. Pass an earlier run's file as --baseline to
+print each number as a ratio of the old one.
+
+Example - benchmark, then benchmark a change against it:
+    python Connect4_Bench.py --out before.json
+    python Connect4_Bench.py --out after.json --baseline before.json
+'''
+
+#Random games (no wins) at a few stages, with no win for the side to move.
+corpus = {
+    'opening': ['67', '26532', '235635', '4767352', '7643456', '26764677'],
+    'middlegame': ['737537576451', '2152726515225', '52741736441662',
+                   '12462321274264', '43372344352742213',
+                   '76572243223457623'],
+    'endgame': ['73213575225514157734522161',
+                '2125175575615152673114242247',
+                '62424336465777245474622256136',
+                '65463247315656173165521773177',
+                '31656145414337353457657716425',
+                '635432156532244351362423417542667'],
+}
+
+engines = ['max', 'prob', 'search', 'mcts']
+
+
+def make_game(engine, nodes, iterations, seed = 0):
+    #A headless connect_four with fixed budgets and seeds, and no solver.
+    game = connect_four(None, 1, engine = engine)
+    game.solver.max_empty = 0
+    game.rng = np.random.RandomState(seed)
+    game.set_budget(None, nodes, iterations)
+    game.mcts.rng.seed(seed)
+    return game
+
+def percentiles(times):
+    #Latency summary in ms.
+    ms = 1000 * np.array(times)
+    return {'mean_ms': round(float(ms.mean()), 4),
+            'p50_ms': round(float(np.percentile(ms, 50)), 4),
+            'p95_ms': round(float(np.percentile(ms, 95)), 4),
+            'p99_ms': round(float(np.percentile(ms, 99)), 4),
+            'max_ms': round(float(ms.max()), 4)}
+
+def bench_engine(engine, repeats, nodes, iterations):
+    '''
+    Time engine picking a move in every corpus position, repeats times
+    each. The search's table is cleared before each position so the runs
+    don't depend on the order. Returns {phase: stats}.
+    '''
+    game = make_game(engine, nodes, iterations)
+    results = {}
+    for phase, positions in corpus.items():
+        times = []
+        work = 0
+        for r in range(repeats):
+            for moves in positions:
+                board = bit_board.from_moves(moves)
+                game.search.tt.clear()
+                start = time.perf_counter()
+                game.pick_move(board, board.next_player())
+                times.append(time.perf_counter() - start)
+                if engine == 'search':
+                    work += game.search.nodes
+                elif engine == 'mcts':
+                    work += game.mcts.playouts
+        stats = percentiles(times)
+        stats['moves'] = len(times)
+        if engine == 'search':
+            stats['nodes_per_s'] = round(work / sum(times))
+        elif engine == 'mcts':
+            stats['playouts_per_s'] = round(work / sum(times))
+        stats.update(memory_per_move(game, positions))
+        results[phase] = stats
+    return results
+
+def memory_per_move(game, positions):
+    '''
+    Memory use of a move, traced: the mean number of bytes allocated and
+    not yet freed at the highest point of the move, and the bytes still
+    held once it's done (eg in the transposition table).
+    '''
+    peak = 0
+    kept = 0
+    tracemalloc.start()
+    for moves in positions:
+        board = bit_board.from_moves(moves)
+        game.search.tt.clear()
+        tracemalloc.reset_peak()
+        before, p = tracemalloc.get_traced_memory()
+        game.pick_move(board, board.next_player())
+        after, p = tracemalloc.get_traced_memory()
+        peak += p - before
+        kept += after - before
+    tracemalloc.stop()
+    n = len(positions)
+    return {'peak_kb': round(peak / 1024.0 / n, 2),
+            'kept_kb': round(kept / 1024.0 / n, 2)}
+
+def bench_solver(repeats):
+    '''
+    Time endgame_solver.best_move on the endgame positions, repeats times
+    each. The cache is cleared before every position, so each solve starts
+    cold. Returns the latency stats and nodes per second.
+    '''
+    solver = endgame_solver()
+    times = []
+    nodes = 0
+    for r in range(repeats):
+        for moves in corpus['endgame']:
+            board = bit_board.from_moves(moves)
+            solver.cache.clear()
+            start = time.perf_counter()
+            solver.best_move(board, board.next_player())
+            times.append(time.perf_counter() - start)
+            nodes += solver.nodes
+    stats = percentiles(times)
+    stats['moves'] = len(times)
+    stats['nodes_per_s'] = round(nodes / sum(times))
+    return stats
+
+def bench_flex(repeats):
+    #Mean microseconds per calc_flexibility and evaluate call, over the corpus.
+    game = connect_four(None, 1)
+    boards = [bit_board.from_moves(m) for ms in corpus.values() for m in ms]
+    calls = 0
+    start = time.perf_counter()
+    for r in range(repeats):
+        for board in boards:
+            for pos in board.opens():
+                game.calc_flexibility(pos, 1, board)
+                game.calc_flexibility(pos, 2, board)
+                calls += 2
+    flex_us = 1e6 * (time.perf_counter() - start) / calls
+    start = time.perf_counter()
+    for r in range(repeats):
+        for board in boards:
+            game.evaluate(board, board.next_player())
+    eval_us = 1e6 * (time.perf_counter() - start) / (repeats * len(boards))
+    return {'calc_flexibility_us': round(flex_us, 3),
+            'evaluate_us': round(eval_us, 3)}
+
+def run_suite(names, repeats = 3, nodes = 20000, iterations = 1000):
+    #Every benchmark, as a dict ready to write out.
+    start = time.time()
+    results = {'flex': bench_flex(10 * repeats),
+               'solver': bench_solver(repeats)}
+    for engine in names:
+        results[engine] = bench_engine(engine, repeats, nodes, iterations)
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'repeats': repeats, 'nodes': nodes,
+                     'iterations': iterations,
+                     'seconds': round(time.time() - start, 1),
+                     #ru_maxrss is kB on Linux.
+                     'peak_rss_mb': round(resource.getrusage( \
+                         resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)},
+            'results': results}
+
+def flatten(results, prefix = ''):
+    #{'search': {'opening': {'p50_ms': 1}}} to {'search.opening.p50_ms': 1}
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def report(run, baseline = None):
+    #Print every number, with new / old when there's a baseline.
+    old = {}
+    if baseline is not None:
+        old = flatten(baseline['results'])
+    for key, value in flatten(run['results']).items():
+        line = key.ljust(40) + str(value).rjust(12)
+        if old.get(key):
+            line += ("x" + str(round(value / float(old[key]), 3))).rjust(10)
+        print(line)
+    print("Peak RSS:", run['meta']['peak_rss_mb'], "MB in", \
+        run['meta']['seconds'], "s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = \
+        "Benchmark the connect_four AI engines.")
+    parser.add_argument("--engines", nargs = "+", default = engines, \
+        choices = engines)
+    parser.add_argument("--repeats", type = int, default = 3, \
+        help = "times each position is timed")
+    parser.add_argument("--nodes", type = int, default = 20000, \
+        help = "search nodes per move")
+    parser.add_argument("--iterations", type = int, default = 1000, \
+        help = "mcts iterations per move")
+    parser.add_argument("--out", default = "bench.json", \
+        help = "results file (.json)")
+    parser.add_argument("--baseline", default = None, \
+        help = "earlier results file to compare against")
+    args = parser.parse_args()
+    run = run_suite(args.engines, args.repeats, args.nodes, args.iterations)
+    with open(args.out, 'w') as f:
+        json.dump(run, f, indent = 1)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(run, baseline)
@@ -0,0 +1,102 @@
+import argparse
+import multiprocessing
+import time
+import numpy as np
+from Connect4 import bit_board, connect_four
+
+'''
+Builds the opening book that connect_four looks its early moves up in.
+
+Every position reachable within the first few plies is searched once with
+ai_search, and its best move is written to a sorted .npy file keyed by the
+position's Zobrist hash (see opening_book in Connect4.py for the layout).
+Searching is spread over a process pool as it's by far the slow part.
+Books for other board sizes or k in a row can be built too, but
+connect_four only opens the standard 7x6 connect 4 one by default.
+
+Example - book every position up to 6 plies in, 20000 search nodes each:
+    python Connect4_Book.py connect4_book.npy --plies 6 --nodes 20000
+'''
+
+
+def book_positions(max_ply, size_x = 7, size_y = 6, k = 4):
+    '''
+    Every position reachable in at most max_ply moves that isn't already
+    won, once each (transpositions are only kept the first time).
+
+    Returns a list of move strings.
+    '''
+    board = bit_board(size_x, size_y, k)
+    seen = set()
+    positions = []
+
+    def visit(player):
+        if board.hash in seen:
+            return
+        seen.add(board.hash)
+        positions.append(board.to_moves())
+        if len(board.moves) == max_ply:
+            return
+        for column in board.legal_moves():
+            board.make(column, player)
+            if not board.is_win(player):
+                visit(3 - player)
+            board.unmake()
+
+    visit(1)
+    return positions
+
+#Each worker process keeps its own headless game for the search.
+worker_game = None
+
+def init_worker(time_limit, node_limit, size_x = 7, size_y = 6, k = 4):
+    global worker_game
+    worker_game = connect_four(None, 1, engine = 'search', size_x = size_x, \
+        size_y = size_y, k = k)
+    worker_game.set_budget(time_limit, node_limit)
+
+def book_entry(moves):
+    #Search one position, returns its packed book entry.
+    board = bit_board.from_moves(moves, worker_game.size_x, \
+        worker_game.size_y, worker_game.k)
+    column, score = worker_game.search.best_move(board, board.next_player())
+    return (board.hash >> 8 << 8) | column
+
+def build_book(path, max_ply, time_limit = None, node_limit = 20000, \
+    workers = None, size_x = 7, size_y = 6, k = 4):
+    '''
+    Search every position up to max_ply moves in and write the book to path.
+    workers is the number of processes, None for one per core.
+    '''
+    start = time.time()
+    positions = book_positions(max_ply, size_x, size_y, k)
+    print("Searching", len(positions), "positions")
+    pool = multiprocessing.Pool(workers, init_worker, (time_limit, node_limit, \
+        size_x, size_y, k))
+    entries = pool.map(book_entry, positions, chunksize = 64)
+    pool.close()
+    pool.join()
+    entries = np.sort(np.array(entries, dtype = np.uint64))
+    np.save(path, entries)
+    print("Wrote", len(entries), "entries to", path, \
+        "in", round(time.time() - start, 1), "s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = \
+        "Precompute the connect_four opening book.")
+    parser.add_argument("path", help = "book file to write (.npy)")
+    parser.add_argument("--plies", type = int, default = 6, \
+        help = "book positions up to this many moves in")
+    parser.add_argument("--time", type = float, default = None, \
+        help = "search seconds per position")
+    parser.add_argument("--nodes", type = int, default = 20000, \
+        help = "search nodes per position")
+    parser.add_argument("--workers", type = int, default = None, \
+        help = "worker processes, default one per core")
+    parser.add_argument("--width", type = int, default = 7)
+    parser.add_argument("--height", type = int, default = 6)
+    parser.add_argument("--k", type = int, default = 4, help = "k in a row wins")
+    args = parser.parse_args()
+    build_book(args.path, args.plies, args.time, args.nodes, args.workers, \
+        args.width, args.height, args.k)
@@ -0,0 +1,152 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import random
+import time
+import numpy as np
+from Connect4 import bit_board, connect_four
+
+'''
+Headless AI vs AI tournaments for connect_four, spread over a process pool.
+
+Two engines (any connect_four engine - 'max', 'prob', 'search', 'mcts') play a
+number of games, swapping who goes first every game. Each game is seeded
+from the base seed and its number, so a tournament can be rerun exactly
+(time limited searches aside). The first few plies can be played at random
+so the deterministic engines don't play the same game over and over.
+
+Every game's result is written out as soon as it finishes, to a .csv or a
+.jsonl file (picked from the file extension), with the winner, game length
+and per-move latency of both engines. Any board size and k in a row can
+be played (--width, --height, --k).
+
+Example - 1000 games of the 2-ply heuristic against the search:
+    python Connect4_Tournament.py max search --games 1000 --out results.csv
+'''
+
+engines = ['max', 'prob', 'search', 'mcts']
+
+fields = ['game', 'seed', 'player1', 'player2', 'winner', 'result', 'plies',
+          'moves', 'a_mean_ms', 'a_max_ms', 'b_mean_ms', 'b_max_ms']
+
+
+def make_player(engine, seed, time_limit, node_limit, size = (7, 6, 4)):
+    #A headless connect_four that only picks moves for one side.
+    size_x, size_y, k = size
+    player = connect_four(None, 1, engine = engine, size_x = size_x, \
+        size_y = size_y, k = k)
+    player.rng = np.random.RandomState(seed)
+    player.set_budget(time_limit, node_limit)
+    player.mcts.rng = random.Random(seed)
+    return player
+
+def play_game(task):
+    '''
+    Play one game. task is (game number, engine a, engine b, seed, random
+    opening plies, search time limit, search node limit, (size_x, size_y,
+    k)). Engine a moves first in even numbered games and second in odd ones.
+
+    Returns the result row, with the result from engine a's side.
+    '''
+    game, engine_a, engine_b, seed, opening, time_limit, node_limit, size = task
+    rng = random.Random(seed)
+    a = make_player(engine_a, seed, time_limit, node_limit, size)
+    b = make_player(engine_b, seed + 1, time_limit, node_limit, size)
+    sides = [None, a, b]
+    names = [None, 'a', 'b']
+    if game % 2 == 1:
+        sides = [None, b, a]
+        names = [None, 'b', 'a']
+    board = bit_board(*size)
+    latency = {'a': [], 'b': []}
+    player = 1
+    winner = 0
+    while winner == 0 and not board.is_full():
+        if len(board.moves) < opening:
+            column = rng.choice(board.legal_moves())
+        else:
+            side = sides[player]
+            start = time.perf_counter()
+            column = side.pick_move(board, player)[0]
+            latency[names[player]].append(time.perf_counter() - start)
+        board.make(column, player)
+        if board.is_win(player):
+            winner = player
+        player = 3 - player
+
+    result = 'draw'
+    if winner != 0:
+        result = 'loss'
+        if names[winner] == 'a':
+            result = 'win'
+    row = {'game': game, 'seed': seed,
+           'player1': engine_a if names[1] == 'a' else engine_b,
+           'player2': engine_b if names[1] == 'a' else engine_a,
+           'winner': winner, 'result': result, 'plies': len(board.moves),
+           'moves': board.to_moves()}
+    for name in ('a', 'b'):
+        times = latency[name]
+        if len(times) == 0:
+            times = [0.0]
+        row[name + '_mean_ms'] = round(1000 * sum(times) / len(times), 3)
+        row[name + '_max_ms'] = round(1000 * max(times), 3)
+    return row
+
+def tournament(engine_a, engine_b, games, out, seed = 0, opening = 2, \
+    time_limit = 0.1, node_limit = None, workers = None, size = (7, 6, 4)):
+    '''
+    Play games between engine_a and engine_b over workers processes (None
+    for one per core), streaming each result row to the file out. size is
+    the board's (size_x, size_y, k). Returns engine a's (wins, draws, losses).
+    '''
+    tasks = ((game, engine_a, engine_b, seed + 2 * game, opening, \
+        time_limit, node_limit, size) for game in range(games))
+    counts = {'win': 0, 'draw': 0, 'loss': 0}
+    jsonl = out.endswith('.jsonl')
+    pool = multiprocessing.Pool(workers)
+    with open(out, 'w', newline = '') as f:
+        writer = None
+        if not jsonl:
+            writer = csv.DictWriter(f, fieldnames = fields)
+            writer.writeheader()
+        for row in pool.imap_unordered(play_game, tasks, chunksize = 4):
+            counts[row['result']] += 1
+            if jsonl:
+                f.write(json.dumps(row) + '\n')
+            else:
+                writer.writerow(row)
+            f.flush()
+    pool.close()
+    pool.join()
+    return counts['win'], counts['draw'], counts['loss']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = \
+        "Play connect_four engines against each other.")
+    parser.add_argument("engine_a", choices = engines)
+    parser.add_argument("engine_b", choices = engines)
+    parser.add_argument("--games", type = int, default = 100)
+    parser.add_argument("--out", default = "tournament.csv", \
+        help = "results file, .csv or .jsonl")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--opening", type = int, default = 2, \
+        help = "number of random moves to start each game with")
+    parser.add_argument("--time", type = float, default = 0.1, \
+        help = "search/mcts seconds per move")
+    parser.add_argument("--nodes", type = int, default = None, \
+        help = "search nodes (or mcts iterations) per move")
+    parser.add_argument("--workers", type = int, default = None, \
+        help = "worker processes, default one per core")
+    parser.add_argument("--width", type = int, default = 7)
+    parser.add_argument("--height", type = int, default = 6)
+    parser.add_argument("--k", type = int, default = 4, help = "k in a row wins")
+    args = parser.parse_args()
+    start = time.time()
+    wins, draws, losses = tournament(args.engine_a, args.engine_b, \
+        args.games, args.out, args.seed, args.opening, args.time, \
+        args.nodes, args.workers, (args.width, args.height, args.k))
+    print(args.engine_a, "vs", args.engine_b, "- wins:", wins, \
+        "draws:", draws, "losses:", losses)
+    print("Took", round(time.time() - start, 1), "s")